@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#
+# Predicts ninja build wall time by replaying its scheduler over the
+# manifest graph, with edge durations from the last build's .ninja_log.
+# Answers "what-if" questions without running the build: other -j values
+# and pool depths, or the graph with some changes applied.
+#
+# example usage (in the build dir, after a build):
+#   buildsim.py -j 8 16 32
+#   buildsim.py -j 16 --pool link_pool:4 --speedup app:2 --remove-dep b.o:gen.h
+#   buildsim.py -j 16 --touch inc/common.h --split inc/common.h:4
+
+import argparse
+import heapq
+import os
+import sys
+from collections import defaultdict
+
+import deps
+from deps import V1, info, warn, fatal
+
+class BuildModel(object):
+    """
+    Edges of a manifest as seen by the scheduler: dependencies, durations
+    (seconds, by edge index) and pools. What-if changes are applied to the
+    model, not to the shared EdgeTable.
+    """
+    def __init__(self, edge_table, durations, pools):
+        self.nodes = edge_table.nodes
+        self.edges = edge_table.edges
+        self.id2edge = edge_table.id2edge
+        self.durations = durations
+        self.pools = pools # edge index -> pool name, None for the default pool
+        self.requires_ids = [list(edge.requires_ids) for edge in self.edges]
+        self.order_only_ids = [list(ids) for ids in edge_table.order_only_ids]
+        self.depfile_ids = [list(ids) for ids in edge_table.depfile_ids]
+        self.touched = set() # node ids, an incremental build if any
+        self.next_part_id = len(self.nodes.paths) # split file parts get ids after the node table ones
+
+    def get_id(self, path):
+        node_id = self.nodes.get_id(os.path.normpath(path))
+        if node_id is None:
+            fatal("Unknown target: %r", path)
+        return node_id
+
+    def get_edge(self, target):
+        edge = self.id2edge.get(self.get_id(target))
+        if edge is None:
+            fatal("No edge builds target: %r", target)
+        return edge
+
+    def touch(self, path):
+        self.touched.add(self.get_id(path))
+
+    def speedup(self, target, factor):
+        self.durations[self.get_edge(target).index] /= factor
+
+    def remove_dep(self, target, dep):
+        index, dep_id = self.get_edge(target).index, self.get_id(dep)
+        found = False
+        for ids in (self.requires_ids, self.order_only_ids, self.depfile_ids):
+            if dep_id in ids[index]:
+                ids[index].remove(dep_id)
+                found = True
+        if not found:
+            warn("%r doesn't depend on %r", target, dep)
+
+    def split(self, path, parts):
+        """Split a file (e.g., a header) into 'parts' files, each of its users
+        depending on one of them, round-robin. Touching the file then stands
+        for touching its first part only."""
+        path_id = self.get_id(path)
+        users = [i for i in range(len(self.edges))
+                 if path_id in self.requires_ids[i] or path_id in self.depfile_ids[i]]
+        part_ids = [path_id] + list(range(self.next_part_id, self.next_part_id + parts - 1))
+        self.next_part_id += parts - 1
+        for n, i in enumerate(users):
+            for ids in (self.requires_ids, self.depfile_ids):
+                ids[i] = [part_ids[n % parts] if v == path_id else v for v in ids[i]]
+        V1("Split %r into %d parts among %d users", path, parts, len(users))
+
+    def _get_edge_deps_ids(self, i):
+        return self.requires_ids[i] + self.order_only_ids[i] + self.depfile_ids[i]
+
+    def get_edges_to_run(self, targets):
+        """Returns indices of the edges building 'targets' (all if none),
+        only those rebuilt after touching the touched files if any."""
+        if targets:
+            wanted = set()
+            queue = [self.get_id(t) for t in targets]
+            seen = set(queue)
+            for v in queue:
+                edge = self.id2edge.get(v)
+                if edge is None or edge.index in wanted:
+                    continue
+                wanted.add(edge.index)
+                for w in self._get_edge_deps_ids(edge.index):
+                    if w not in seen:
+                        seen.add(w)
+                        queue.append(w)
+        else:
+            wanted = set(range(len(self.edges)))
+        if not self.touched:
+            return wanted
+
+        # Order-only dependencies don't trigger rebuilds
+        users = defaultdict(list) # node id -> edges indices
+        for i in wanted:
+            for v in self.requires_ids[i] + self.depfile_ids[i]:
+                users[v].append(i)
+        dirty = set()
+        queue = list(self.touched)
+        for v in queue:
+            for i in users.get(v, ()):
+                if i not in dirty:
+                    dirty.add(i)
+                    queue.extend(self.edges[i].provides_ids)
+        return dirty
+
+class BuildPlan(object):
+    """
+    The edges to run with dependencies among them, in topological order and
+    prioritized by the critical path to the end of the build, as ninja does.
+    Edges in dependency loops are dropped.
+    """
+    def __init__(self, model, run):
+        self.model = model
+        self.dependents = defaultdict(list) # edge index -> edges indices waiting for it
+        self.waits = dict() # edge index -> number of edges it waits for
+        for i in run:
+            deps_edges = set()
+            for v in model._get_edge_deps_ids(i):
+                edge = model.id2edge.get(v)
+                if edge is not None and edge.index in run and edge.index != i:
+                    deps_edges.add(edge.index)
+            self.waits[i] = len(deps_edges)
+            for j in deps_edges:
+                self.dependents[j].append(i)
+
+        waits = dict(self.waits)
+        self.order = [i for i in run if not waits[i]]
+        for i in self.order:
+            for j in self.dependents[i]:
+                waits[j] -= 1
+                if not waits[j]:
+                    self.order.append(j)
+        if len(self.order) < len(run):
+            warn("Edges in dependency loops, not simulated: %d", len(run) - len(self.order))
+
+        self.priority = dict() # edge index -> critical path from its start to the end
+        for i in reversed(self.order):
+            self.priority[i] = model.durations[i] + max((self.priority[j] for j in self.dependents[i]), default=0.0)
+
+    def get_work(self):
+        return sum(self.model.durations[i] for i in self.order)
+
+def simulate(plan, jobs, pool_depths):
+    """
+    Replay the scheduler: ready edges start by priority as long as less than
+    'jobs' edges run and their pool isn't full. Phony edges finish as soon
+    as they are ready, not taking a job. Returns the build wall time.
+    """
+    model = plan.model
+    durations, pools, edges = model.durations, model.pools, model.edges
+    waits = dict((i, plan.waits[i]) for i in plan.order)
+    ready = [(-plan.priority[i], i) for i in plan.order if not waits[i]]
+    heapq.heapify(ready)
+    running = [] # (finish time, edge index)
+    pool_running = defaultdict(int)
+    pool_delayed = defaultdict(list) # pool -> ready edges waiting for the pool
+    now = 0.0
+    jobs_running = 0
+    while ready or running:
+        while ready and jobs_running < jobs:
+            item = heapq.heappop(ready)
+            i = item[1]
+            if edges[i].is_phony:
+                heapq.heappush(running, (now, i))
+                continue
+            pool = pools[i]
+            if pool is not None:
+                if pool_depths.get(pool, 0) and pool_running[pool] >= pool_depths[pool]:
+                    heapq.heappush(pool_delayed[pool], item)
+                    continue
+                pool_running[pool] += 1
+            heapq.heappush(running, (now + durations[i], i))
+            jobs_running += 1
+        if not running:
+            break
+        now, i = heapq.heappop(running)
+        if not edges[i].is_phony:
+            jobs_running -= 1
+            pool = pools[i]
+            if pool is not None:
+                pool_running[pool] -= 1
+                if pool_delayed[pool]:
+                    heapq.heappush(ready, heapq.heappop(pool_delayed[pool]))
+        for j in plan.dependents.get(i, ()):
+            waits[j] -= 1
+            if not waits[j]:
+                heapq.heappush(ready, (-plan.priority[j], j))
+    return now
+
+def get_durations(edge_table, ninja_log):
+    """Edge durations from 'ninja_log', the mean of the known ones for edges
+    not in the log (or 1 without a log) and 0 for phony edges."""
+    durations = [None] * len(edge_table.edges)
+    paths = edge_table.nodes.paths
+    for edge in edge_table.edges:
+        if edge.is_phony:
+            durations[edge.index] = 0.0
+        elif ninja_log is not None:
+            durations[edge.index] = ninja_log.get_edge_duration([paths[i] for i in edge.provides_ids])
+    known = [d for edge, d in zip(edge_table.edges, durations) if d is not None and not edge.is_phony]
+    default = sum(known) / len(known) if known else 1.0
+    if None in durations:
+        V1("Edges with unknown durations: %d, taking %.3fs each",
+           sum(1 for d in durations if d is None), default)
+    return [default if d is None else d for d in durations]
+
+def _split_arg(arg, convert=str):
+    name, sep, value = arg.rpartition(':')
+    if not sep or not name:
+        fatal("Expecting NAME:VALUE, got: %r", arg)
+    try:
+        return name, convert(value)
+    except ValueError:
+        fatal("Invalid value in: %r", arg)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='buildsim')
+    parser.add_argument('-C', dest='dir', help='change to DIR before doing anything else')
+    parser.add_argument('-f', dest='manifest', default=deps._DEFAULT_MANIFEST, help='specify input ninja manifest')
+    parser.add_argument('-j', dest='jobs', type=int, nargs='+', default=[os.cpu_count() or 1],
+                        help='simulate running N jobs in parallel, for each N given')
+    parser.add_argument('--pool', action='append', default=[], metavar='POOL:DEPTH',
+                        help='override the depth of a pool')
+    parser.add_argument('--touch', action='append', default=[], metavar='FILE',
+                        help='simulate an incremental build after touching FILE')
+    parser.add_argument('--speedup', action='append', default=[], metavar='TARGET:FACTOR',
+                        help='what if the edge building TARGET was FACTOR times faster')
+    parser.add_argument('--remove-dep', action='append', default=[], metavar='TARGET:DEP',
+                        help='what if TARGET did not depend on DEP')
+    parser.add_argument('--split', action='append', default=[], metavar='FILE:N',
+                        help='what if FILE was split into N files, used by 1/N of its users each')
+    parser.add_argument('-v', dest='verbose', action='count', default=0, help='increase verbosity')
+    parser.add_argument('targets', nargs='*', help='targets to build [default: manifest defaults, or all]')
+    args = parser.parse_args()
+    speedups = [_split_arg(arg, float) for arg in args.speedup]
+    splits = [_split_arg(arg, int) for arg in args.split]
+    for arg, (_, factor) in zip(args.speedup, speedups):
+        if not factor > 0:
+            parser.error("--speedup FACTOR must be positive, got: %r" % arg)
+    for arg, (_, parts) in zip(args.split, splits):
+        if parts < 1:
+            parser.error("--split N must be at least 1, got: %r" % arg)
+
+    deps._verbose = args.verbose
+    if args.dir:
+        V1("Changing working dir to: %r", args.dir)
+        os.chdir(args.dir)
+
+    info("Parsing Ninja manifest..")
+    with open(args.manifest, "r") as manifest_file:
+        ninja_parser = deps.NinjaManifestParser(manifest_file)
+    edge_table = deps.EdgeTable(ninja_parser.iterate_target_rules(), deps.NodeTable())
+    ninja_log = deps.load_ninja_log(ninja_parser)
+    if ninja_log is None:
+        warn("No edge durations, simulating in units of one edge duration")
+    pools = [ninja_parser.get_edge_pool(edge) for edge in ninja_parser.edges]
+    pool_depths = dict(ninja_parser.pools)
+    pool_depths.update(_split_arg(arg, int) for arg in args.pool)
+    targets = args.targets or ninja_parser.get_default_targets()
+
+    durations = get_durations(edge_table, ninja_log)
+    def make_model():
+        model = BuildModel(edge_table, list(durations), pools)
+        for path in args.touch:
+            model.touch(path)
+        return model
+
+    baseline = make_model()
+    changed = make_model()
+    for target, factor in speedups:
+        changed.speedup(target, factor)
+    for target, dep in (_split_arg(arg) for arg in args.remove_dep):
+        changed.remove_dep(target, dep)
+    for path, parts in splits:
+        changed.split(path, parts)
+    what_if = bool(args.speedup or args.remove_dep or args.split)
+
+    plans = [("baseline", BuildPlan(baseline, baseline.get_edges_to_run(targets)))]
+    if what_if:
+        plans.append(("what-if", BuildPlan(changed, changed.get_edges_to_run(targets))))
+    for name, plan in plans:
+        info("%s: %d edges, work %.1fs, critical path %.1fs", name, len(plan.order), plan.get_work(),
+             max(plan.priority.values(), default=0.0))
+
+    for jobs in args.jobs:
+        times = [simulate(plan, jobs, pool_depths) for _, plan in plans]
+        line = "-j %3d: %10.1fs (%3.0f%% busy)" % (
+            jobs, times[0], 100.0 * plans[0][1].get_work() / (times[0] * jobs) if times[0] else 0)
+        if what_if:
+            line += ", what-if: %10.1fs (%+.1f%%)" % (
+                times[1], 100.0 * (times[1] - times[0]) / times[0] if times[0] else 0)
+        deps.V0(line)
+    sys.exit(0)
@@ -15,16 +15,36 @@
 # limitations under the License.
 
 import argparse
+import ast
+import atexit
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
 import re
+import struct
 import sys
 import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 _DEPSLINT_CFG = '.depslint'
 _DEFAULT_TRACEFILE = 'deps.lst'
 _DEFAULT_MANIFEST = 'build.ninja'
 _SUPPORTED_NINJA_VER = 1.2
+_TRACE_FORMAT = 'depstrace'
+_SUPPORTED_TRACE_FORMAT_VER = 1
+_HASHES_FORMAT = 'depstrace-hashes'
+_NINJA_DEPS_LOG = '.ninja_deps'
+_NINJA_LOG = '.ninja_log'
+_DEPFILES_CACHE = '.depslint_depfiles.cache'
+_LINT_CACHE = '.depslint_lint.cache'
+# Depfiles and targets are handed to worker processes in chunks of
+_DEPFILES_CHUNK = 256
+_LINT_CHUNK = 512
 
 # Matching targets are silently dropped when loading trace file, as if these
 # were never accessed.
@@ -48,19 +68,38 @@ _verbose = 0
 
 global _logfile
 _logfile = None
+_LOGFILE_BUFFER = 1 << 16
 def _set_logger(filename):
-    if not filename:
-        filename = '/dev/null'
+    # The log file is buffered, flushed on exit (and before forking workers)
     global _logfile
-    _logfile = open(filename, "w")
+    if filename:
+        _logfile = open(filename, "w", buffering=_LOGFILE_BUFFER)
+        atexit.register(_logfile.close)
+
+def flush_log():
+    if _logfile is not None:
+        _logfile.flush()
+    sys.stdout.flush()
+
+_log_time = [None, None] # [second, its asctime()]
+def _log_write(msg):
+    if _logfile is None:
+        return
+    now = int(time.time())
+    if now != _log_time[0]:
+        _log_time[:] = [now, time.asctime(time.localtime(now))]
+    _logfile.write("[%s] %s\n" % (_log_time[1], msg))
 
-def log_msg(level, msg, trunc_lines=True, ansi=None, fd=sys.stdout):
+def log_msg(level, msg, args=(), trunc_lines=True, ansi=None, fd=sys.stdout):
+    """Log 'msg % args', formatting it only if it's logged at all"""
     if _verbose < 0:
         # Testing mode: be silent
         return
 
     if _verbose >= level:
-        _logfile.write("[%s] %s\n" % (time.asctime(), msg))
+        if args:
+            msg = msg % args
+        _log_write(msg)
 
         if trunc_lines and len(msg) > 140:
             msg = msg[:137] + "..."
@@ -73,59 +112,127 @@ def log_msg(level, msg, trunc_lines=True, ansi=None, fd=sys.stdout):
 
     # Always log levels 0 and 1
     if level in (0, 1):
-        _logfile.write("[%s] %s\n" % (time.asctime(), msg))
+        _log_write(msg % args if args else msg)
 
 def H0():
     log_msg(0, "")
 
-def V0(msg, trunc_lines=True):
-    log_msg(0, msg, trunc_lines)
+def V0(msg, *args, trunc_lines=True):
+    log_msg(0, msg, args, trunc_lines)
 
-def V1(msg, trunc_lines=True):
-    log_msg(1, msg, trunc_lines)
+def V1(msg, *args, trunc_lines=True):
+    log_msg(1, msg, args, trunc_lines)
 
-def V2(msg, trunc_lines=True):
-    log_msg(2, msg, trunc_lines)
+# Levels 2 and 3 are only logged when enabled, check it before any call
+def V2(msg, *args, trunc_lines=True):
+    if _verbose >= 2:
+        log_msg(2, msg, args, trunc_lines)
 
-def V3(msg, trunc_lines=True):
-    log_msg(3, msg, trunc_lines)
+def V3(msg, *args, trunc_lines=True):
+    if _verbose >= 3:
+        log_msg(3, msg, args, trunc_lines)
 
-def fatal(msg, ret=-1):
-    msg = "FATAL: %s" % msg
-    log_msg(0, msg, trunc_lines=False, ansi='\033[1;41m', fd=sys.stderr)
+def fatal(msg, *args, ret=-1):
+    log_msg(0, "FATAL: " + msg, args, trunc_lines=False, ansi='\033[1;41m', fd=sys.stderr)
     sys.exit(ret)
 
-def error(msg):
-    msg = "ERROR: %s" % msg
-    log_msg(0, msg, trunc_lines=False, ansi='\033[1;31m')
+def error(msg, *args):
+    log_msg(0, "ERROR: " + msg, args, trunc_lines=False, ansi='\033[1;31m')
 
-def warn(msg):
-    msg = "WARNING: %s" % msg
-    log_msg(0, msg, trunc_lines=False, ansi='\033[1;33m')
+def warn(msg, *args):
+    log_msg(0, "WARNING: " + msg, args, trunc_lines=False, ansi='\033[1;33m')
 
-def info(msg):
-    msg = "INFO: %s" % msg
-    log_msg(0, msg, ansi='\033[1;32m')
+def info(msg, *args):
+    log_msg(0, "INFO: " + msg, args, ansi='\033[1;32m')
 
-def debug(msg):
-    msg = "DEBUG: %s" % msg
-    log_msg(0, msg, ansi='\033[1;34m')
+def debug(msg, *args):
+    log_msg(0, "DEBUG: " + msg, args, ansi='\033[1;34m')
 
 def is_ignored(target):
     return any(target.endswith(suffix) for suffix in _IGNORED_SUFFICES)
 
+class _AnyOf(object):
+    """Matches like the first of 'regexes' matching, for patterns which
+    can't be joined into a single alternation (backreferences, flags, ..)."""
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+    def match(self, s):
+        for r in self.regexes:
+            m = r.match(s)
+            if m:
+                return m
+        return None
+
+def _compile_any(regexes):
+    if not regexes:
+        return None
+    if len(regexes) == 1:
+        return regexes[0]
+    if any(r.groups or r.flags != re.U for r in regexes):
+        # Group numbers and global flags would leak into the other branches
+        return _AnyOf(regexes)
+    try:
+        return re.compile('|'.join('(?:%s)' % r.pattern for r in regexes))
+    except re.error:
+        return _AnyOf(regexes)
+
+class ImplicitDepsMatcher(object):
+    """
+    Compiled (target regexp, dependency regexp) pairs of implicit dependencies.
+    All dependency regexps are joined into a single prefilter, dependencies
+    passing it are mapped to an alternation of the target regexps of all the
+    pairs matching the dependency. Both mappings and target matches are cached.
+    """
+    def __init__(self, matchers):
+        self.matchers = matchers
+        self.deps_re = _compile_any([dep_re for _, dep_re in matchers])
+        self.dep2targets_re = dict()
+        self.targets_res = dict() # matching pairs indices -> targets alternation
+        self.matched = dict() # (targets alternation, target) -> bool
+
+    def get_targets_re(self, dep):
+        """Returns a regexp matching targets implicitly depending on 'dep', or None"""
+        try:
+            return self.dep2targets_re[dep]
+        except KeyError:
+            pass
+        targets_re = None
+        if self.deps_re is not None and self.deps_re.match(dep):
+            key = tuple(i for i, (_, dep_re) in enumerate(self.matchers) if dep_re.match(dep))
+            targets_re = self.targets_res.get(key)
+            if targets_re is None:
+                targets_re = self.targets_res[key] = _compile_any([self.matchers[i][0] for i in key])
+        self.dep2targets_re[dep] = targets_re
+        return targets_re
+
+    def match(self, dep, targets):
+        targets_re = self.get_targets_re(dep)
+        if targets_re is None:
+            return None
+        V3("Found a rule matching %r, checking for any target match..", dep)
+        matched = self.matched
+        for t in targets:
+            key = (targets_re, t)
+            m = matched.get(key)
+            if m is None:
+                m = matched[key] = targets_re.match(t) is not None
+            if m:
+                return t
+        return None
+
+_implicit_deps_matcher = None
+
+def get_implicit_deps_matcher():
+    global _implicit_deps_matcher
+    if _implicit_deps_matcher is None or _implicit_deps_matcher.matchers is not _IMPLICIT_DEPS_MATCHERS:
+        _implicit_deps_matcher = ImplicitDepsMatcher(_IMPLICIT_DEPS_MATCHERS)
+    return _implicit_deps_matcher
+
 def match_implicit_dependency(dep, targets):
     """Verify if any of paths in 'targets' depends implicitly on 'dep'
     to inhibit a 'missing dependency' error."""
-    V3("looking for an implicit dependency for any of %r on %r" % (targets, dep))
-    for target_re, dep_re in _IMPLICIT_DEPS_MATCHERS:
-        if not re.match(dep_re, dep):
-            continue
-        V3("Found a rule matching %r, checking for any target match.." % dep)
-        for t in targets:
-            if re.match(target_re, t):
-                return t
-    return None
+    return get_implicit_deps_matcher().match(dep, targets)
 
 def trc_filter_ignored(targets):
     return [t for t in targets if not is_ignored(t)]
@@ -162,7 +269,252 @@ class DepfileParser(object):
     def _unescape(self, string):
         return re.sub(self._depfile_unescape_re, r'\1', string)
 
+def _depfile_stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+def _read_and_parse_depfiles(paths):
+    # Runs in worker processes, returns parsed depfiles, or None for unreadable ones
+    parser = DepfileParser()
+    parsed = []
+    for path in paths:
+        try:
+            with open(path, 'r') as depfile:
+                buf = depfile.read()
+        except OSError:
+            parsed.append(None)
+            continue
+        parsed.append(parser.parse_depfile(buf))
+    return parsed
+
+class DepfileLoader(object):
+    """Reads and parses depfiles, in parallel when asked to. Parsed depfiles
+    are cached by (path, mtime, size), the cache can be saved for reuse."""
+    def __init__(self, jobs=1, cache_path=None):
+        self.jobs = jobs
+        self.cache_path = cache_path
+        self.cache = dict() # (path, mtime, size) -> (targets, deps)
+        self.used_keys = set()
+        if cache_path and os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as f:
+                self.cache = pickle.load(f)
+            V1("Loaded %d cached depfiles from: %r", len(self.cache), cache_path)
+
+    def save(self, prune=True):
+        if not self.cache_path:
+            return
+        # Drop stale entries, only depfiles loaded by this run are kept unless
+        # it loaded some of them only
+        cache = dict((k, self.cache[k]) for k in self.used_keys) if prune else self.cache
+        with open(self.cache_path, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        return self.load_all([path])[0]
+
+    def load_all(self, paths):
+        """Returns parsed (targets, deps) per depfile path, None if unreadable"""
+        results = [None] * len(paths)
+        keys = [_depfile_stat_key(p) for p in paths]
+        todo = []
+        for i, key in enumerate(keys):
+            if key is None:
+                continue
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[i] = cached
+                self.used_keys.add(key)
+            else:
+                todo.append(i)
+        if not todo:
+            return results
+
+        todo_paths = [paths[i] for i in todo]
+        if self.jobs > 1 and len(todo) > _DEPFILES_CHUNK:
+            V1("Loading %d depfiles in %d processes...", len(todo), self.jobs)
+            chunks = [todo_paths[i:i + _DEPFILES_CHUNK] for i in range(0, len(todo_paths), _DEPFILES_CHUNK)]
+            flush_log()
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                parsed = [p for chunk in pool.map(_read_and_parse_depfiles, chunks) for p in chunk]
+        else:
+            parsed = _read_and_parse_depfiles(todo_paths)
+
+        for i, p in zip(todo, parsed):
+            results[i] = p
+            if p is not None:
+                self.cache[keys[i]] = p
+                self.used_keys.add(keys[i])
+        return results
+
+class NinjaDepsLogParser(object):
+    """Reads dependencies of 'deps = gcc|msvc' edges from ninja's binary deps log.
+
+    The log is a signature and a version, followed by records led by their
+    size, with the high bit set for deps records. A path record is a path
+    padded to 4 bytes and a checksum, getting the next path id; a deps
+    record is an output path id, its mtime and input path ids. Later
+    records of an output override earlier ones."""
+    _signature = b'# ninjadeps\n'
+    _supported_versions = (3, 4)
+
+    def __init__(self, path):
+        self.paths = list()
+        self.deps = dict() # output path id -> input path ids
+        self.mtimes = dict() # output path id -> mtime (ns) of the output when its deps were recorded
+        with open(path, 'rb') as f:
+            self._parse(f.read())
+
+    def _parse(self, buf):
+        if not buf.startswith(self._signature):
+            raise Exception("Not a ninja deps log")
+        offset = len(self._signature)
+        version, = struct.unpack_from('<i', buf, offset)
+        if version not in self._supported_versions:
+            raise Exception("Unsupported ninja deps log version: %d" % version)
+        offset += 4
+        mtime_size = 8 if version >= 4 else 4
+        while offset + 4 <= len(buf):
+            size, = struct.unpack_from('<I', buf, offset)
+            offset += 4
+            is_deps, size = size & 0x80000000, size & 0x7FFFFFFF
+            if offset + size > len(buf):
+                # Truncated by an interrupted build
+                break
+            if is_deps:
+                out_id, = struct.unpack_from('<i', buf, offset)
+                if version >= 4:
+                    self.mtimes[out_id], = struct.unpack_from('<q', buf, offset + 4)
+                else:
+                    self.mtimes[out_id] = struct.unpack_from('<I', buf, offset + 4)[0] * 1000000000
+                count = (size - 4 - mtime_size) // 4
+                self.deps[out_id] = struct.unpack_from('<%di' % count, buf, offset + 4 + mtime_size)
+            else:
+                # The path is followed by a checksum, the complement of its id
+                self.paths.append(buf[offset:offset + size - 4].rstrip(b'\0').decode())
+            offset += size
+        self.ids = dict((p, i) for i, p in enumerate(self.paths))
+
+    def get_mtime(self, target):
+        """Returns the mtime of 'target' when its deps were recorded, None if there are none"""
+        return self.mtimes.get(self.ids.get(target))
+
+    def get_deps(self, target):
+        """Returns dependencies recorded for 'target', None if there are none"""
+        deps = self.deps.get(self.ids.get(target))
+        if deps is None:
+            return None
+        return norm_paths(self.paths[i] for i in deps)
+
+class NinjaLogParser(object):
+    """Reads edge durations from ninja's build log.
+
+    The log is a version header followed by a line per output built: tab
+    separated start and end times (ms since the build start), output mtime,
+    output path and command hash (the command itself up to v4). Later lines of an output override earlier
+    ones, so the durations are those of the last build of each output."""
+    _header = '# ninja log v'
+    _supported_versions = (4, 5, 6, 7)
+
+    def __init__(self, path):
+        self.durations = dict() # output path -> seconds
+        self.entries = dict() # output path -> (mtime in ns, command hash)
+        self.version = None
+        with open(path, 'r') as f:
+            self._parse(f)
+
+    def _parse(self, f):
+        header = f.readline()
+        if not header.startswith(self._header):
+            raise Exception("Not a ninja log")
+        self.version = version = int(header[len(self._header):])
+        if version not in self._supported_versions:
+            raise Exception("Unsupported ninja log version: %d" % version)
+        for line in f:
+            fields = line.rstrip('\n').split('\t', 4)
+            if len(fields) < 5:
+                # Truncated by an interrupted build
+                continue
+            output = os.path.normpath(fields[3])
+            self.durations[output] = (int(fields[1]) - int(fields[0])) / 1000.0
+            # Log v4 mtimes are in seconds, and commands are not hashed
+            if version < 5:
+                self.entries[output] = (int(fields[2]) * 1000000000, hash_command(fields[4], version))
+            else:
+                self.entries[output] = (int(fields[2]), int(fields[4], 16))
+
+    def get_edge_duration(self, outputs):
+        """Returns the duration of the edge building 'outputs', None if unknown"""
+        durations = [self.durations[o] for o in outputs if o in self.durations]
+        return max(durations) if durations else None
+
+def hash_command(command, log_version=7):
+    """ninja's command hash as recorded in its build log: MurmurHash64A up
+    to log v6, rapidhash from v7"""
+    if log_version >= 7:
+        return _rapidhash(command.encode())
+    m, r, mask = 0xc6a4a7935bd1e995, 47, 0xFFFFFFFFFFFFFFFF
+    data = command.encode()
+    h = 0xDECAFBADDECAFBAD ^ (len(data) * m & mask)
+    blocks = len(data) // 8 * 8
+    for k, in struct.iter_unpack('<Q', data[:blocks]):
+        k = k * m & mask
+        k ^= k >> r
+        h = (h ^ (k * m & mask)) * m & mask
+    if blocks < len(data):
+        h = (h ^ int.from_bytes(data[blocks:], 'little')) * m & mask
+    h ^= h >> r
+    h = h * m & mask
+    return h ^ (h >> r)
+
+_RAPID_SECRET = (0x2d358dccaa6c78a5, 0x8bb84b93962eacc9, 0x4b33a62ed433d4a3)
+
+def _rapid_mum(a, b):
+    r = a * b
+    return r & 0xFFFFFFFFFFFFFFFF, r >> 64
+
+def _rapid_mix(a, b):
+    lo, hi = _rapid_mum(a, b)
+    return lo ^ hi
+
+def _rapidhash(data, seed=0xbdd89aa982704029):
+    s = _RAPID_SECRET
+    n = len(data)
+    r64 = lambda i: int.from_bytes(data[i:i + 8], 'little')
+    r32 = lambda i: int.from_bytes(data[i:i + 4], 'little')
+    seed ^= _rapid_mix(seed ^ s[0], s[1]) ^ n
+    if n <= 16:
+        if n >= 4:
+            delta = (n & 24) >> (n >> 3)
+            a = r32(0) << 32 | r32(n - 4)
+            b = r32(delta) << 32 | r32(n - 4 - delta)
+        elif n > 0:
+            a, b = data[0] << 56 | data[n >> 1] << 32 | data[n - 1], 0
+        else:
+            a = b = 0
+    else:
+        p, i = 0, n
+        if i > 48:
+            see1 = see2 = seed
+            while i >= 48:
+                seed = _rapid_mix(r64(p) ^ s[0], r64(p + 8) ^ seed)
+                see1 = _rapid_mix(r64(p + 16) ^ s[1], r64(p + 24) ^ see1)
+                see2 = _rapid_mix(r64(p + 32) ^ s[2], r64(p + 40) ^ see2)
+                p, i = p + 48, i - 48
+            seed ^= see1 ^ see2
+        if i > 16:
+            seed = _rapid_mix(r64(p) ^ s[2], r64(p + 8) ^ seed ^ s[1])
+            if i > 32:
+                seed = _rapid_mix(r64(p + 16) ^ s[2], r64(p + 24) ^ seed)
+        a, b = r64(p + i - 16), r64(p + i - 8)
+    a, b = _rapid_mum(a ^ s[1], b ^ seed)
+    return _rapid_mix(a ^ s[0] ^ n, b ^ s[1])
+
 class BuildRule(object):
+    __slots__ = ('targets', 'deps', 'depfile_deps', 'order_only_deps', 'rule_name')
+
     def __init__(self, targets, deps, depfile_deps=[], order_only_deps=[], rule_name=""):
         self.targets = targets
         self.deps = deps
@@ -177,47 +529,166 @@ class BuildRule(object):
             self.order_only_deps)
 
 class TraceParser(object):
+    """Streams build rules from a trace file written by strace_ninja.py.
+
+    Reads the compact 'depstrace' JSON lines format (a shared path table
+    plus integer-indexed 'IN'/'OUT' lists), and falls back to the legacy
+    one-dict-repr-per-line format for older trace files."""
     def __init__(self, input):
         self.input = input
         self.lineno = 0
+        self.paths = list() # path id -> path
 
     def _iterate_target_rules(self, input):
-        for self.lineno, line in enumerate(input, start=1):
-            tok = eval(line)
+        first_line = input.readline()
+        if not first_line:
+            return
+        header = json.loads(first_line) if first_line.startswith('{"') else None
+        if header is None or header.get('FORMAT') != _TRACE_FORMAT:
+            V1("Legacy trace file format detected")
+            yield from self._iterate_legacy_target_rules(first_line, input)
+            return
+        if header.get('VERSION', 0) > _SUPPORTED_TRACE_FORMAT_VER:
+            warn("Trace file format version is newer than supported %s vs %s",
+                 header.get('VERSION'), _SUPPORTED_TRACE_FORMAT_VER)
+
+        paths = self.paths
+        loads = json.loads
+        for self.lineno, line in enumerate(input, start=2):
+            tok = loads(line)
+            new_paths = tok.get('PATHS')
+            if new_paths:
+                paths.extend(new_paths)
+            targets = trc_filter_ignored([paths[i] for i in tok['OUT']])
+            deps = trc_filter_ignored([paths[i] for i in tok['IN']])
+            if not targets:
+                warn("Trace record at line %d has no targets after filtering: %r", self.lineno, tok)
+            yield BuildRule(targets=targets, deps=deps)
+
+    def _iterate_legacy_target_rules(self, first_line, input):
+        for self.lineno, line in enumerate(itertools.chain([first_line], input), start=1):
+            tok = ast.literal_eval(line)
             targets = trc_filter_ignored(tok['OUT'])
             deps = trc_filter_ignored(tok['IN'])
             if not targets:
-                warn("Trace record at line %d has no targets after filtering: %r" % (self.lineno, tok))
+                warn("Trace record at line %d has no targets after filtering: %r", self.lineno, tok)
             yield BuildRule(targets=targets, deps=deps)
 
     def iterate_target_rules(self):
         return self._iterate_target_rules(self.input)
 
+class Scope(object):
+    """Variables bound in a manifest (or a build block), holding values
+    evaluated when bound. Unbound variables are looked up in the parent scope."""
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.bindings = dict()
+
+    def lookup(self, name):
+        scope = self
+        while scope is not None:
+            value = scope.bindings.get(name)
+            if value is not None:
+                return value
+            scope = scope.parent
+        return ""
+
+class EdgeScope(object):
+    """Variables lookup of an edge, following ninja: edge bindings, then rule
+    bindings evaluated in the edge scope, then the enclosing scope.
+    Evaluated values are memoized."""
+    def __init__(self, parser, scope, rule_attrs):
+        self.parser = parser
+        self.scope = scope
+        self.rule_attrs = rule_attrs
+        self.evaluated = dict()
+
+    def lookup(self, name):
+        value = self.evaluated.get(name)
+        if value is not None:
+            return value
+        value = self.scope.bindings.get(name)
+        if value is None:
+            rule_value = self.rule_attrs.get(name)
+            if rule_value is None:
+                value = self.scope.parent.lookup(name)
+            else:
+                # Mark as being evaluated to break rule variables cycles
+                self.evaluated[name] = ""
+                value = self.parser._eval_attribute(self, rule_value)
+        self.evaluated[name] = value
+        return value
+
 class NinjaManifestParser(object):
-    def __init__(self, input):
+    """Parses a ninja manifest into build rules. Depfiles (and the deps log
+    for 'deps = gcc|msvc' edges) are loaded in bulk after parsing, by 'jobs'
+    processes, or on demand if 'lazy_depfiles' is set."""
+    def __init__(self, input, jobs=1, lazy_depfiles=False, depfiles_cache=None):
         self.input = input
         self.lineno = 0
+        self.depfile_loader = DepfileLoader(jobs, depfiles_cache)
+        self.deps_log = None
+        self.loaded_depfiles = set() # edges
 
-        self.global_attributes = dict()
-        self.edges_attributes = dict()
+        self.global_scope = Scope()
+        self.global_attributes = self.global_scope.bindings
+        self.edge_scopes = dict()
         self.edges = list()
+        self.target2edge = dict()
         self.default_targets = []
+        self.pools = dict(console=1) # name -> depth, 0 for unlimited
         self.ninja_required_version = 0.0
 
         # Initializing rules list with a 'phony' rule
-        self.rules = dict(phony=dict(attributes=[]))
+        self.rules = dict(phony=dict(attributes=dict()))
 
         self._parse()
-        # FIXME: should do this 'per tested target tree' / or on
-        # demand. Becomes less urgent with ninja 'deps' support.
-        self._load_depfiles()
+        self.lazy_depfiles = lazy_depfiles
+        if not lazy_depfiles:
+            self._load_depfiles(self.edges)
 
     def iterate_target_rules(self):
+        """Build rules, with only the depfiles loaded so far if 'lazy_depfiles' is set"""
         return iter(self.edges)
 
+    def load_edge_depfile(self, edge):
+        """Load depfile dependencies of an edge unless loaded already, returns the edge"""
+        if edge not in self.loaded_depfiles:
+            self._load_depfiles([edge])
+        return edge
+
+    def load_target_depfile(self, target):
+        """Load depfile dependencies of the edge building 'target', returns the edge or None"""
+        edge = self.target2edge.get(target)
+        return edge and self.load_edge_depfile(edge)
+
+    def load_targets_depfiles(self, targets):
+        """Load depfile dependencies of the edges 'targets' are built from,
+        returns the number of these edges"""
+        visited = set()
+        stack = [os.path.normpath(t) for t in targets]
+        while stack:
+            edge = self.load_target_depfile(stack.pop())
+            if edge is None or edge in visited:
+                continue
+            visited.add(edge)
+            stack.extend(edge.deps + edge.order_only_deps + edge.depfile_deps)
+        return len(visited)
+
     def get_default_targets(self):
         return self.default_targets
 
+    def get_edge_pool(self, edge):
+        """Returns the name of the pool an edge runs in, None for the default pool"""
+        return self._eval_edge_attribute(edge, 'pool') or None
+
+    def get_target_attribute(self, target, attribute):
+        """Evaluate 'attribute' of the edge building 'target', None if there is no such edge"""
+        edge = self.target2edge.get(target)
+        if edge is None:
+            return None
+        return self._eval_edge_attribute(edge, attribute)
+
     def _parse(self):
         for blk in self._iterate_manifest_blocks(self.input):
             if blk[0].startswith('build '):
@@ -235,28 +706,39 @@ class NinjaManifestParser(object):
             else:
                 self._handle_globals(blk)
 
-    def _read_depfile(self, path):
-        file_content = None
-        if os.path.isfile(path):
-            with open(path, 'r') as depfile:
-                file_content = depfile.read()
-        return file_content
-
-    def _load_depfiles(self):
-        parser = DepfileParser()
-        for edge in self.edges:
-            # TODO: support 'deps' dependencies format
+    def _get_deps_log(self):
+        if self.deps_log is None:
+            path = os.path.join(self.global_attributes.get('builddir', ''), _NINJA_DEPS_LOG)
+            try:
+                self.deps_log = NinjaDepsLogParser(path)
+                V1("Loaded ninja deps log: %r", path)
+            except Exception as e:
+                warn("Ninja deps log %r couldn't be read (%s), falling back to depfiles", path, e)
+                self.deps_log = False
+        return self.deps_log
+
+    def _load_depfiles(self, edges):
+        edges_depfiles = []
+        for edge in edges:
+            self.loaded_depfiles.add(edge)
             if self._eval_edge_attribute(edge, 'deps'):
-                warn("'deps' dependencies format specified for targets %r is not supported") #% (list(edge.provides), ))
+                # Dependencies are in the deps log, unless depfiles were kept ('-d keepdepfile')
+                deps_log = self._get_deps_log()
+                deps = deps_log and deps_log.get_deps(edge.targets[0])
+                if deps is not None:
+                    edge.depfile_deps = deps
+                    continue
 
             depfile = self._eval_edge_attribute(edge, 'depfile')
-            if not depfile:
-                continue
-            buf = self._read_depfile(depfile)
-            if buf is None:
-                warn("Depfile '%s' couldn't be read, ignoring" % (depfile, ))
+            if depfile:
+                edges_depfiles.append((edge, depfile))
+
+        parsed = self.depfile_loader.load_all([depfile for _, depfile in edges_depfiles])
+        for (edge, depfile), depfile_content in zip(edges_depfiles, parsed):
+            if depfile_content is None:
+                warn("Depfile '%s' couldn't be read, ignoring", depfile)
                 continue
-            dep_targets, dep_inputs = parser.parse_depfile(buf)
+            dep_targets, dep_inputs = depfile_content
             if set(dep_targets) ^ set(edge.targets):
                 # Note: ninja doesn't accept depfile specifying more
                 # than one target, we currently do..
@@ -267,28 +749,36 @@ class NinjaManifestParser(object):
             # manifest 'deps' (as these are taking effect even on the 1st build)
             # TODO: treat manifest dependencies the same
             if self._eval_edge_attribute(edge, 'reload'):
-                V3("'reload' attribute set for edge generating: %r" % (edge.targets,))
+                V3("'reload' attribute set for edge generating: %r", edge.targets)
                 if depfile not in set(edge.targets):
-                    warn("Rule with 'reload' attribute doesn't mention depfile in targets: %r" % (edge.targets,))
+                    warn("Rule with 'reload' attribute doesn't mention depfile in targets: %r", edge.targets)
                 edge.deps += dep_inputs
                 continue
 
             edge.depfile_deps = dep_inputs
 
     def _handle_globals(self, blk):
-        global_attr = dict(self._parse_attributes(blk))
-        self.global_attributes.update(global_attr)
+        # Evaluated as parsed, e.g. 'cflags = $cflags -g' extends the previous value
+        global_attr = dict()
+        for k, v in self._parse_attributes(blk):
+            global_attr[k] = self.global_attributes[k] = self._eval_attribute(self.global_scope, v)
         if global_attr:
-            V2("** Set global attribute: %r" % global_attr)
+            V2("** Set global attribute: %r", global_attr)
         self._check_required_version(global_attr)
 
     def _handle_default_blk(self, blk):
         targets_str = blk[0][len('default '):]
-        self.default_targets = self._split_unescape_and_eval(targets_str, self.global_attributes)
+        self.default_targets = self._split_unescape_and_eval(targets_str, self.global_scope)
 
+    _pool_re = re.compile(r'pool\s+(?P<pool>.+?)\s*$')
     def _handle_pool_blk(self, blk):
-        # Just skipping over
-        pass
+        match = re.match(self._pool_re, blk[0])
+        if not match:
+            raise Exception("Error parsing manifest at line:%d: '%s'" % (self.lineno-len(blk), blk[0]))
+        attributes = dict(self._parse_attributes(blk[1:]))
+        depth = self._eval_attribute(self.global_scope, attributes.get('depth', '0'))
+        self.pools[match.group('pool')] = int(depth)
+        V2("** Pool %s, depth: %s", match.group('pool'), depth)
 
     def _handle_include(self, blk):
         fatal("'include' keyword support not implemented, wanna help?")
@@ -300,29 +790,28 @@ class NinjaManifestParser(object):
         if self.ninja_required_version:
             return
         self.ninja_required_version = float(attrs.get('ninja_required_version', 0))
-        V2(f"** ninja_required_version: {self.ninja_required_version}")
+        V2("** ninja_required_version: %s", self.ninja_required_version)
         if self.ninja_required_version > _SUPPORTED_NINJA_VER:
-            warn(f"Ninja version required in manifest is newer than supported {self.ninja_required_version} vs {_SUPPORTED_NINJA_VER}")
+            warn("Ninja version required in manifest is newer than supported %s vs %s",
+                 self.ninja_required_version, _SUPPORTED_NINJA_VER)
             warn("Trying to continue but the results may be meaningless...")
 
     _build_re = re.compile(r'build\s+(?P<out>.+)\s*'+
                            r'(?<!\$):\s*(?P<rule>\S+)'+
                            r'\s*(?P<all_deps>.*)\s*$')
     def _handle_build_blk(self, blk):
-        V3("** Parsing build block: '%s'" % (blk[0], ))
+        V3("** Parsing build block: '%s'", blk[0])
         match = re.match(self._build_re, blk[0])
         if not match:
             raise Exception("Error parsing manifest at line:%d: '%s'" % (self.lineno-len(blk), blk[0]))
         targets, rule, all_deps = match.groups()
         ins, implicit, order = self._split_deps(all_deps)
 
-        # TODO: fix to evaluate along the parsing to avoid possible cycles
-        edge_attrs = dict(self._parse_attributes(blk[1:]))
-
-        # prep attributes scope
-        scope = self.global_attributes.copy()
-        scope.update(self._get_rule_attrs(rule))
-        scope.update(edge_attrs)
+        # Edge bindings are evaluated in the enclosing scope as parsed,
+        # paths in the edge scope (rule bindings don't apply to paths)
+        scope = Scope(parent=self.global_scope)
+        for k, v in self._parse_attributes(blk[1:]):
+            scope.bindings[k] = self._eval_attribute(self.global_scope, v)
 
         # evaluate targets and dependencies
         targets = norm_paths(self._split_unescape_and_eval(targets, scope))
@@ -331,16 +820,18 @@ class NinjaManifestParser(object):
         order = norm_paths(self._split_unescape_and_eval(order, scope))
 
         # Add automatic variables
-        edge_attrs.update({'out':" ".join(targets), 'in':" ".join(ins)})
+        scope.bindings.update({'out':" ".join(targets), 'in':" ".join(ins)})
 
         edge = BuildRule(targets=targets,
                     deps=ins + implicit,
                     depfile_deps=[],
                     order_only_deps=order,
                     rule_name=rule)
-        V2("** BuildRule** ", str(edge))
+        V2("** BuildRule** %s", edge)
         self.edges.append(edge)
-        self.edges_attributes[edge] = edge_attrs
+        self.edge_scopes[edge] = EdgeScope(self, scope, self._get_rule_attrs(rule))
+        for t in targets:
+            self.target2edge[t] = edge
 
     _rule_re = re.compile(r'rule\s+(?P<rule>.+?)\s*$')
     def _handle_rule_blk(self, blk):
@@ -403,103 +894,158 @@ class NinjaManifestParser(object):
         ins, implicit, order = match.group('in'), match.group('deps'), match.group('ord')
         return (ins or "", implicit or "", order or "")
 
+    _unescape_re = re.compile(r'\$([ :$])')
     def _unescape(self, string):
         # Unescape '$ ', '$:', '$$' sequences
-        return re.sub(r'\$([ :$])', r'\1', string)
+        if '$' not in string:
+            return string
+        return self._unescape_re.sub(r'\1', string)
 
     _deps_sep_re = re.compile(r'(?<!\$)\s+') # Unescaped spaces
-    def _split_and_unescape(self, s):
+    def _split(self, s):
         if not s:
             return []
-        return [self._unescape(s) for s in re.split(self._deps_sep_re, s) if s != '']
+        return [s for s in re.split(self._deps_sep_re, s) if s != '']
 
     def _get_rule_attrs(self, rule):
         return self.rules[rule]['attributes']
 
-    def _get_edge_attrs(self, edge):
-        return self.edges_attributes[edge]
-
     def _split_unescape_and_eval(self, s, scope):
-        lst = [self._eval_attribute(scope, x) for x in self._split_and_unescape(s)]
-        V3(">> split_unescape_and_eval('%s') -> '%s'" % (s, lst))
+        lst = [self._unescape(self._eval_attribute(scope, x)) for x in self._split(s)]
+        V3(">> split_unescape_and_eval('%s') -> '%s'", s, lst)
         return lst
 
     _attr_sub_re = re.compile(r'(?<!\$)\$(\{)?(?P<attr>\w+)(?(1)})') # $attr or ${attr}
     def _eval_attribute(self, scope, attribute):
-        # TBD: use empty strings for undefined attributes or raise?
-        V3(">>> evaluating attribute: '%s'" % attribute)
-        def evaluator(match):
-            V3(">>> Evaluating replacement for attr:", match.group('attr'))
-            attribute_val = scope.get(match.group('attr'), "")
-            return self._eval_attribute(scope, attribute_val)
-        evaluated_attr = re.sub(self._attr_sub_re, evaluator, attribute)
-        V3(">>> evaluated attribute: '%s' -> '%s'" % (attribute, evaluated_attr))
+        # Values bound in scopes are evaluated already, a single substitution pass is enough.
+        # Undefined attributes evaluate to empty strings, as in ninja.
+        if '$' not in attribute:
+            return attribute
+        evaluated_attr = self._attr_sub_re.sub(lambda m: scope.lookup(m.group('attr')), attribute)
+        V3(">>> evaluated attribute: '%s' -> '%s'", attribute, evaluated_attr)
         return evaluated_attr
 
-    # TODO: fix variables substituation according to ninja's rules. E.g., need to eval as we parse.
     def _eval_edge_attribute(self, edge, attribute):
-        scope = self.global_attributes.copy()
-        scope.update(self._get_rule_attrs(edge.rule_name))
-        scope.update(self._get_edge_attrs(edge))
-        V3(">> eval_edge_attribute('%s': '%s')" % (scope, attribute))
-        attribute_val = scope.get(attribute, "")
-        return self._unescape(self._eval_attribute(scope, attribute_val))
+        return self._unescape(self.edge_scopes[edge].lookup(attribute))
+
+def iterate_bits(bits):
+    """Iterate over indices of bits set in an integer used as a bitset"""
+    digits = bin(bits)[:1:-1] # least significant first, '0b' dropped
+    i = digits.find('1')
+    while i >= 0:
+        yield i
+        i = digits.find('1', i + 1)
+
+class NodeTable(object):
+    """Interns graph nodes (target paths) to integer ids"""
+    def __init__(self):
+        self.ids = dict()   # path -> id
+        self.paths = list() # id -> path
+
+    def intern(self, path):
+        node_id = self.ids.get(path)
+        if node_id is None:
+            node_id = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return node_id
+
+    def get_id(self, path):
+        return self.ids.get(path)
+
+    def paths_of(self, bits):
+        paths = self.paths
+        return set(paths[i] for i in iterate_bits(bits))
 
 class Edge(object):
-    def __init__(self, provides, requires, is_phony):
-        self.provides = frozenset(provides)
-        self.requires = frozenset(requires)
+    """Build edge over interned node ids. Edges are shared by all graphs
+    built from the same build rules, graph specific data (ranks, extra
+    dependencies) is kept by graphs and indexed by edge 'index'."""
+    __slots__ = ('index', 'provides_ids', 'requires_ids', 'is_phony')
+
+    def __init__(self, index, provides_ids, requires_ids, is_phony):
+        self.index = index
+        self.provides_ids = provides_ids
+        self.requires_ids = requires_ids
         self.is_phony = is_phony
-        self.rank = None
-
-class Graph(object):
-    def __init__(self, from_brules, targets_wanted, is_clean_build_graph):
-        self.target2edge  = dict()
-        self.source2edges = defaultdict(set)
 
+def _intern_all(nodes, paths):
+    # Unique ids, in order. Note: CPython shares the empty tuple.
+    return tuple(dict.fromkeys(nodes.intern(p) for p in paths))
+
+class EdgeTable(object):
+    """Edges of build rules, shared by the graphs built from them (e.g.,
+    clean build and incremental build graphs of a manifest). Order-only and
+    depfile dependencies are kept aside, per edge index, as graphs differ
+    only by which of these play."""
+    def __init__(self, from_brules, nodes):
+        self.nodes = nodes
+        self.edges = list()
+        self.order_only_ids = list()
+        self.depfile_ids = list()
+        self.id2edge = dict()
         self.duplicate_target_rules = set()
 
+        for brule in from_brules:
+            edge = Edge(index=len(self.edges),
+                        provides_ids=_intern_all(nodes, brule.targets),
+                        requires_ids=_intern_all(nodes, brule.deps),
+                        is_phony=(brule.rule_name == "phony"))
+            self.edges.append(edge)
+            self.order_only_ids.append(_intern_all(nodes, brule.order_only_deps))
+            self.depfile_ids.append(_intern_all(nodes, brule.depfile_deps))
+            # Populate targets dictionary, take note of duplicate target
+            # rules.
+            for t in edge.provides_ids:
+                if t in self.id2edge:
+                    self.duplicate_target_rules.add(nodes.paths[t])
+                self.id2edge[t] = edge
+
+class Graph(object):
+    def __init__(self, edge_table, targets_wanted, is_clean_build_graph):
+        self.nodes = edge_table.nodes
+        self.edges = edge_table.edges
+        self.id2edge = edge_table.id2edge
+        self.duplicate_target_rules = edge_table.duplicate_target_rules
+
+        # Clean build graph - as everything is rebuilt, only build
+        # order matters. Depfiles do not exist.  Incremental build
+        # - depfiles exist, and order rules can be neglected
+        # assuming that clean order build is correct (and a
+        # missing depfile triggers target rebuild).  Implicit and
+        # explicit dependencies from manifest always play.
+        self.extra_requires_ids = edge_table.order_only_ids if is_clean_build_graph else edge_table.depfile_ids
+        self.source2edges = defaultdict(list) # node id -> edges requiring it
+        self.edge_ranks = [None] * len(self.edges)
+
         self.top_targets = list(targets_wanted)
         self.targets_by_ranks = defaultdict(set)
 
+        # Deps closures are bitsets of node ids, shared by all the targets of an edge,
+        # products closures are bitsets of edges indices. Both are keyed by node ids.
         self.target_deps_closure = dict()
         self.target_products_closure = dict()
+        self.cycles = list()
+        self.components_order = list() # strongly connected components, dependencies first
+        self._fingerprints = None
+        self._top_parents = None
 
-        for brule in from_brules:
-            # Clean build graph - as everything is rebuilt, only build
-            # order matters. Depfiles do not exist.  Incremental build
-            # - depfiles exist, and order rules can be neglected
-            # assuming that clean order build is correct (and a
-            # missing depfile triggers target rebuild).  Implicit and
-            # explicit dependencies from manifest always play.
-            deps = brule.deps + (brule.order_only_deps if is_clean_build_graph else brule.depfile_deps)
-            edge = Edge(provides=brule.targets,
-                        requires=deps,
-                        is_phony=(brule.rule_name == "phony"))
-            self._add_edge(edge)
+        for edge in self.edges:
+            for s in set(self.get_requires_ids(edge)):
+                self.source2edges[s].append(edge)
 
         self._eval_graph_properties()
 
-    def _add_edge(self, edge):
-        # Populate targets dictionary, take note of duplicate target
-        # rules.
-        for t in edge.provides:
-            if self.target2edge.get(t):
-                self.duplicate_target_rules.add(t)
-            self.target2edge[t] = edge
-        for s in edge.requires:
-            self.source2edges[s].add(edge)
-
     def _eval_graph_properties(self):
         if not self.top_targets:
             V1("Finding all terminal targets...")
             self.top_targets = list(self._find_top_targets())
         #TODO: filter out top_targets w/o an incoming edge?
 
-        V1("Terminal targets (up to first 5): %r" % self.top_targets[:5])
+        V1("Terminal targets (up to first 5): %r", self.top_targets[:5])
         V1("Calculating deps closures and nodes ranks...")
-        for target in self.top_targets:
-            self._calc_deps_closure_in_tree(target)
+        self._calc_deps_closures(self.top_targets)
+        for cycle in self.cycles:
+            error("Dependencies loop detected: %r", cycle)
 
         V1("Calculating targets product closures...")
         self._calc_products_closure_in_tree()
@@ -508,10 +1054,25 @@ class Graph(object):
     def get_edge(self, target):
         """Returns an edge corresponding to target build rule, or
         'None' if there is no rule to build the target (e.g., a static target)."""
-        return self.target2edge.get(target, None)
+        return self.id2edge.get(self.nodes.get_id(target))
+
+    def get_edge_rank(self, edge):
+        return self.edge_ranks[edge.index]
+
+    def get_requires_ids(self, edge):
+        extra = self.extra_requires_ids[edge.index]
+        return edge.requires_ids + extra if extra else edge.requires_ids
+
+    def get_requires(self, edge):
+        paths = self.nodes.paths
+        return [paths[i] for i in self.get_requires_ids(edge)]
+
+    def get_provides(self, edge):
+        paths = self.nodes.paths
+        return [paths[i] for i in edge.provides_ids]
 
     def is_phony_target(self, target):
-        edge = self.target2edge.get(target)
+        edge = self.get_edge(target)
         if not edge:
             return False
         return edge.is_phony
@@ -522,43 +1083,98 @@ class Graph(object):
         otherwise."""
         return target in self.targets_by_ranks[0]
 
+    def is_wanted_target(self, target):
+        return self.nodes.get_id(target) in self.target_deps_closure
+
     def get_any_path_to_top(self, target):
-        out_edges = self.source2edges.get(target, [])
-        out_edges = [e for e in out_edges if self._is_wanted(e)]
-        if not out_edges and target not in self.top_targets:
+        """Returns a shortest path (excluding 'target') to a 'wanted' top target"""
+        parents = self.get_top_parents()
+        v = self.nodes.get_id(target)
+        if v not in parents:
             # If the queried target was 'wanted', there should be a
             # path to a 'wanted' top target.
             raise Exception("Unknown or unwanted target: %r" % target)
-
-        for edge in out_edges:
-            for out in edge.provides:
-                return [out] + self.get_any_path_to_top(out)
-
-        # No outgoing edges, reached the top of the 'wanted' sub-graph
-        return []
-
-    def get_deps_closure(self, target):
+        paths = self.nodes.paths
+        path = []
+        v = parents[v]
+        while v is not None:
+            path.append(paths[v])
+            v = parents[v]
+        return path
+
+    def get_top_parents(self):
+        """Returns a BFS tree from the top targets, as node id -> id of the
+        output of the first edge reached requiring it (None for top targets)"""
+        if self._top_parents is not None:
+            return self._top_parents
+        parents = self._top_parents = dict()
+        queue = [self.nodes.get_id(t) for t in self.top_targets]
+        queue = [v for v in queue if v is not None]
+        for v in queue:
+            parents.setdefault(v, None)
+        for v in queue:
+            edge = self.id2edge.get(v)
+            if edge is None:
+                continue
+            for w in self.get_requires_ids(edge):
+                if w not in parents:
+                    parents[w] = v
+                    queue.append(w)
+        return parents
+
+    def get_fingerprints(self):
+        """Returns a digest per wanted node id, covering the node's edge and,
+        recursively, everything it depends on: a node's fingerprint changes
+        iff its deps closure or any edge in it changes."""
+        if self._fingerprints is not None:
+            return self._fingerprints
+        paths = self.nodes.paths
+        fingerprints = self._fingerprints = dict()
+        for component in self.components_order:
+            for v in component:
+                h = hashlib.blake2b(paths[v].encode(), digest_size=16)
+                edge = self.id2edge.get(v)
+                if edge is not None:
+                    h.update(b'|phony' if edge.is_phony else b'|')
+                    # Dependencies in loops are not fingerprinted yet, their paths are
+                    for w in sorted(self.get_requires_ids(edge), key=paths.__getitem__):
+                        h.update(paths[w].encode())
+                        h.update(fingerprints.get(w, b'\0'))
+                fingerprints[v] = h.digest()
+        return fingerprints
+
+    def _get_target_closure(self, closures, target):
         try:
-            return self.target_deps_closure[target]
+            return closures[self.nodes.get_id(target)]
         except KeyError:
             raise Exception("Unknown or unwanted target: %r" % target)
 
+    def get_deps_closure(self, target):
+        return self.nodes.paths_of(self._get_target_closure(self.target_deps_closure, target))
+
+    def depends_on(self, target, dep):
+        """Returns 'True' if 'dep' is in the deps closure of 'target'"""
+        closure = self._get_target_closure(self.target_deps_closure, target)
+        dep_id = self.nodes.get_id(dep)
+        return dep_id is not None and bool(closure >> dep_id & 1)
+
+    def depends_on_id(self, target_id, dep_id):
+        return bool(self.target_deps_closure[target_id] >> dep_id & 1)
+
     def get_product_rules_closure(self, target):
-        try:
-            return self.target_products_closure[target]
-        except KeyError:
-            raise Exception("Unknown or unwanted target: %r" % target)
+        closure = self._get_target_closure(self.target_products_closure, target)
+        return [self.edges[i] for i in iterate_bits(closure)]
 
     def resolve_phony(self, targets):
         """Substitute phone targets by non-phony dependecies, unless
         target dependencies list is empty."""
         resolved = []
         for t in targets:
-            edge = self.target2edge.get(t)
-            if not edge or not edge.is_phony or not edge.requires:
+            edge = self.get_edge(t)
+            if not edge or not edge.is_phony or not self.get_requires_ids(edge):
                 resolved.append(t)
                 continue
-            resolved.extend(self.resolve_phony(edge.requires))
+            resolved.extend(self.resolve_phony(self.get_requires(edge)))
         return resolved
 
     def iterate_targets_by_rank(self, include_static_targets):
@@ -569,94 +1185,154 @@ class Graph(object):
                 #TODO: sort by significance
                 yield tpath
 
+    def get_products_num(self, target):
+        """Returns the number of rules to rerun if 'target' is touched"""
+        return self._get_target_closure(self.target_products_closure, target).bit_count()
+
+    def get_edge_products_num(self, edge):
+        """Returns the number of rules to rerun after 'edge', whichever of its
+        outputs are wanted"""
+        closure = 0
+        for t in edge.provides_ids:
+            closure |= self.target_products_closure.get(t, 0)
+        return closure.bit_count()
+
     def sorted_by_products_num(self, targets, reverse=False):
-        def by_products(x,y):
-            return cmp(len(self.get_product_rules_closure(x)), len(self.get_product_rules_closure(y)))
-        return sorted(targets, cmp=by_products, reverse=reverse)
+        return sorted(targets, key=self.get_products_num, reverse=reverse)
+
+    def most_impactful_sources(self, k, scored=None):
+        """Returns up to 'k' (source, products number) pairs of wanted static
+        sources triggering most rebuilds, most impactful first. The pairs of
+        all sources are computed unless given as 'scored'."""
+        if scored is None:
+            scored = ((t, self.get_products_num(t)) for t in self.targets_by_ranks[0])
+        return heapq.nlargest(k, scored, key=lambda x: x[1])
 
     def _find_top_targets(self):
         # Top targets are not required by any other target in the build graph
-        top_targets_set = set(self.target2edge.keys()) - set(self.source2edges.keys())
-        if not top_targets_set and self.target2edge:
+        top_targets_set = set(self.id2edge.keys()) - set(self.source2edges.keys())
+        if not top_targets_set and self.id2edge:
             raise Exception("ERROR: could not isolate top targets, check inputs for dependency loops")
-        return sorted(top_targets_set)
-
-    def _calc_deps_closure_in_tree(self, target):
-        visited = list()
-        return self._do_calc_deps_closure(target, visited)
-
-    def _do_calc_deps_closure(self, target, visited):
-        # Cycles detection
-        if target in visited:
-            raise Exception("Dependencies loop detected: %r" % (visited + [target],))
-
-        edge = self.target2edge.get(target, None)
-        if not edge:
+        return sorted(self.nodes.paths[t] for t in top_targets_set)
+
+    def _calc_deps_closures(self, targets):
+        """Calculate deps closures and ranks of nodes reachable from 'targets'.
+
+        Runs an iterative Tarjan's strongly connected components search:
+        components complete after all the components they depend on, which
+        is the order closures are calculated in. A component of more than
+        one node (or a node depending on itself) is a dependencies loop, all
+        of them are recorded in 'cycles' and closed as a single node."""
+        index = dict() # node id -> DFS visiting order
+        lowlink = dict()
+        stack = []
+        on_stack = set()
+        ranks = dict() # node id -> rank
+
+        def children(v):
+            edge = self.id2edge.get(v)
+            return iter(self.get_requires_ids(edge) if edge else ())
+
+        for root in targets:
+            root = self.nodes.intern(root)
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, children(root))]
+            while work:
+                v, v_children = work[-1]
+                for w in v_children:
+                    if w not in index:
+                        index[w] = lowlink[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, children(w)))
+                        break
+                    if w in on_stack:
+                        lowlink[v] = min(lowlink[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        lowlink[u] = min(lowlink[u], lowlink[v])
+                    if lowlink[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            on_stack.discard(w)
+                            component.append(w)
+                            if w == v:
+                                break
+                        self.components_order.append(component)
+                        self._close_component(component, ranks)
+
+    def _close_component(self, component, ranks):
+        paths = self.nodes.paths
+        closures = self.target_deps_closure
+        edges = dict((e.index, e) for e in (self.id2edge.get(v) for v in component) if e)
+        if not edges:
             # Static source
-            self.targets_by_ranks[0].add(target)
-            self.target_deps_closure[target] = set()
-            return 0
+            v = component[0]
+            closures[v] = ranks[v] = 0
+            self.targets_by_ranks[0].add(paths[v])
+            return
+
+        if len(component) == 1 and self.edge_ranks[next(iter(edges))] is not None:
+            # Closed already, as another target of the same edge
+            return
 
-        # Already processed?
-        if edge.rank is not None:
-            return edge.rank
+        members = set(component)
+        if len(component) > 1 or any(v in self.get_requires_ids(e) for e in edges.values() for v in members):
+            self.cycles.append(sorted(paths[v] for v in component))
 
+        closure = 0
         max_children_rank = 0
-        closure = set(edge.requires)
-        for p in edge.requires:
-            max_children_rank = max(self._do_calc_deps_closure(p, visited + [target]), max_children_rank)
-            closure.update(self.target_deps_closure[p])
+        for edge in edges.values():
+            for w in self.get_requires_ids(edge):
+                closure |= closures.get(w, 0) | (1 << w)
+                if w not in members:
+                    max_children_rank = max(ranks[w], max_children_rank)
 
         # Note: phony targets don't climb ranks,
         # non-static target w/no dependencies are ranked '1'
-        rank = edge.rank = max_children_rank + (0 if edge.is_phony else 1)
-        for t in edge.provides:
-            self.target_deps_closure[t] = closure
-            self.targets_by_ranks[rank].add(t)
-        return rank
+        is_phony = all(e.is_phony for e in edges.values())
+        rank = max_children_rank + (0 if is_phony else 1)
+        for edge in edges.values():
+            self.edge_ranks[edge.index] = rank
+            for v in edge.provides_ids:
+                closures[v] = closure
+                ranks[v] = rank
+                self.targets_by_ranks[rank].add(paths[v])
 
     def _is_wanted(self, edge):
-        return edge.rank is not None
+        return self.edge_ranks[edge.index] is not None
 
     def _calc_products_closure_in_tree(self):
-        reachable_sources = self.targets_by_ranks[0]
-        visited = list()
-        # DFS-traverse the DAG bottom-up
-        for source in reachable_sources:
-            self._do_calc_products_closure(source, visited)
-
-    def _do_calc_products_closure(self, source, visited):
-        # TODO: rewrite to use top-down BFS (to limit scope to the specified targets),
-        # see then if it is possible to do 'deps' closure calculation 'on the way back'?
-
-        # Cycles detection (just in case)
-        if source in visited:
-            raise Exception("Dependencies loop detected: %r" % (visited + [source],))
-
-        # Already calculated?
-        my_products = self.target_products_closure.get(source, set())
-        if my_products:
-            return my_products
-
-        for out_edge in self.source2edges.get(source, []):
-            if not self._is_wanted(out_edge):
-                continue
-            for p in out_edge.provides:
-                products = self._do_calc_products_closure(p, visited + [source])
-                my_products.update(products)
-            my_products.add(out_edge)
-        self.target_products_closure[source] = my_products
-        return my_products
-
-def create_graph(path, parser, targets=[], clean_build_graph=False):
-    info("Building %s graph for '%s'.." % (
-        "order-only" if clean_build_graph else "dependency", path))
-    g = Graph(parser.iterate_target_rules(), targets, clean_build_graph)
+        # Propagate products top-down, visiting components in reverse topological
+        # order: products of all the targets built from a node are final by then.
+        products = self.target_products_closure
+        for component in reversed(self.components_order):
+            closure = 0
+            for v in component:
+                for out_edge in self.source2edges.get(v, ()):
+                    if not self._is_wanted(out_edge):
+                        continue
+                    closure |= 1 << out_edge.index
+                    for p in out_edge.provides_ids:
+                        closure |= products.get(p, 0)
+            for v in component:
+                products[v] = closure
+
+def create_graph(path, edge_table, targets=[], clean_build_graph=False):
+    info("Building %s graph for '%s'..", "order-only" if clean_build_graph else "dependency", path)
+    g = Graph(edge_table, targets, clean_build_graph)
     return g
 
 def load_config(path):
     if not os.path.isfile(path):
-        V2("Note: no custom configuration file at: %r" % path)
+        V2("Note: no custom configuration file at: %r", path)
         return None
 
     try:
@@ -664,102 +1340,613 @@ def load_config(path):
         exec(compile(open(path, "rb").read(), path, 'exec'), conf)
     except Exception as e:
         # TODO: give more helpful errors
-        fatal("Error loading configuration file: %r" % e)
+        fatal("Error loading configuration file: %r", e)
 
-    info("Loaded configuration file: %r" % config_path)
+    info("Loaded configuration file: %r", config_path)
     if conf.get('IGNORED_SUFFICES'):
         global _IGNORED_SUFFICES
         _IGNORED_SUFFICES = list(conf.get('IGNORED_SUFFICES'))
-        V1("Set ignored suffices to: %r" % _IGNORED_SUFFICES)
+        V1("Set ignored suffices to: %r", _IGNORED_SUFFICES)
     if conf.get('IMPLICIT_DEPS_MATCHERS'):
         impl_deps = conf.get('IMPLICIT_DEPS_MATCHERS')
         global _IMPLICIT_DEPS_MATCHERS
         _IMPLICIT_DEPS_MATCHERS = list((re.compile(t), re.compile(s)) for t, s in impl_deps)
-        V1("Set implicit matchers to: %r" % impl_deps)
+        V1("Set implicit matchers to: %r", impl_deps)
 
     return conf
 
-def compare_dependencies(trace_graph, manifest_graph, clean_build):
-    missing = defaultdict(list)
-    ignored_missing = defaultdict(list)
-    for tp in manifest_graph.iterate_targets_by_rank(include_static_targets=False):
-        if manifest_graph.is_phony_target(tp):
-            V2("Skipping phony: %s" % tp)
+def load_output_hashes(path):
+    """Load a snapshot of traced outputs hashes written by 'strace_ninja.py --hash-outputs'"""
+    with open(path, "r") as f:
+        snapshot = json.load(f)
+    if snapshot.get('FORMAT') != _HASHES_FORMAT:
+        fatal("Not an outputs hashes snapshot: %r", path)
+    return snapshot['RULES']
+
+def find_restat_candidates(snapshots, manifest_graph, manifest_parser):
+    """
+    Find rules rewriting their outputs byte-identical, given output hashes
+    snapshots of consecutive builds. Such rules are candidates for 'restat = 1'
+    which lets ninja prune the rebuild of everything depending on them.
+
+    Return a list of (outputs, runs, identical rewrites, downstream edges)
+    for rules which are not 'restat' already, sorted by the number of
+    downstream edge rebuilds 'restat' would have saved.
+    """
+    known_hashes = dict() # output -> last known content hash
+    rewrites = dict()     # outputs -> [runs, identical rewrites]
+    for i, rules in enumerate(snapshots):
+        for rule in rules:
+            outputs, hashes = tuple(rule['OUT']), rule['HASH']
+            if i:
+                # Compare with the previous content of outputs still existing
+                compared = [(known_hashes[o], h) for o, h in zip(outputs, hashes)
+                            if h is not None and o in known_hashes]
+                counters = rewrites.setdefault(outputs, [0, 0])
+                counters[0] += 1
+                if compared and all(old == new for old, new in compared):
+                    counters[1] += 1
+            known_hashes.update(zip(outputs, hashes))
+
+    candidates = []
+    for outputs, (runs, identical) in rewrites.items():
+        if not identical:
             continue
-
-        edge_in_trace = trace_graph.get_edge(tp)
-        if not edge_in_trace:
-            warn("manifest target '%s' doesn't present in strace graph" % tp)
+        built_outputs = [o for o in outputs if manifest_graph.is_wanted_target(o)]
+        if not built_outputs:
+            V2("Skipping outputs not built by wanted manifest rules: %r", outputs)
             continue
+        if manifest_parser.get_target_attribute(built_outputs[0], 'restat'):
+            continue
+        downstream = set()
+        for o in built_outputs:
+            downstream.update(e.index for e in manifest_graph.get_product_rules_closure(o) if not e.is_phony)
+        candidates.append((outputs, runs, identical, len(downstream)))
+    candidates.sort(key=lambda c: c[2] * c[3], reverse=True)
+    return candidates
+
+def print_restat_candidates(candidates):
+    if not candidates:
+        info("No issues!")
+        return
+    warn("Rules rewriting outputs byte-identical, consider 'restat = 1': %d", len(candidates))
+    V0("%8s %8s %10s %10s  %s", "runs", "same", "downstream", "skippable", "outputs")
+    for outputs, runs, identical, downstream in candidates:
+        V0("%8d %8d %10d %10d  %s", runs, identical, downstream, identical * downstream, " ".join(outputs))
+    info("Estimated downstream edge rebuilds skipped with 'restat': %d", sum(c[2] * c[3] for c in candidates))
+
+class StatSnapshot(object):
+    """mtimes (ns) of files, listing each of their directories once with
+    os.scandir(): files missing from a listing are not stat()-ed at all."""
+    def __init__(self, paths):
+        self.mtimes = dict() # path -> mtime, missing files are not there
+        by_dir = defaultdict(set)
+        for path in paths:
+            by_dir[os.path.dirname(path)].add(path)
+        for d, wanted in by_dir.items():
+            try:
+                with os.scandir(d or '.') as entries:
+                    for entry in entries:
+                        path = os.path.join(d, entry.name)
+                        if path in wanted:
+                            self.mtimes[path] = entry.stat().st_mtime_ns
+            except OSError:
+                continue
 
-        for dep in edge_in_trace.requires - manifest_graph.get_deps_closure(tp):
-            if clean_build and trace_graph.is_static_target(dep):
-                # Only dependencies on the non-static targets are critical
-                # for a clean build.
+    def get_mtime(self, path):
+        return self.mtimes.get(path)
+
+class DirtyPredictor(object):
+    """
+    Predicts the edges ninja would rebuild, following its rules: an edge is
+    dirty if an output is missing or older than the most recent input (the
+    build log mtime counts for 'restat' edges), if its command changed or
+    isn't in the build log (except for 'generator' edges), if its deps are
+    missing or older than the output, or if an input is built by a dirty
+    edge. Order-only inputs are built but don't make an edge dirty.
+
+    Outputs of 'restat' edges may turn out unchanged, edges dirty only
+    through these are reported apart, as these may be skipped.
+    """
+    CLEAN, MAYBE, DIRTY = 0, 1, 2
+
+    def __init__(self, manifest_parser, edge_table, ninja_log=None):
+        self.parser = manifest_parser
+        self.edge_table = edge_table
+        self.ninja_log = ninja_log
+        self.deps_log = None
+        self.command_hashes = dict() # edge index -> hash, computed once per edge
+
+    def _get_flag(self, edge, attribute):
+        return self.parser._eval_edge_attribute(self.parser.edges[edge.index], attribute)
+
+    def _get_command_hash(self, edge):
+        h = self.command_hashes.get(edge.index)
+        if h is None:
+            command = self._get_flag(edge, 'command')
+            rspfile_content = self._get_flag(edge, 'rspfile_content')
+            if rspfile_content:
+                command += ";rspfile=" + rspfile_content
+            h = self.command_hashes[edge.index] = hash_command(command, self.ninja_log.version)
+        return h
+
+    def _get_inputs(self, edge):
+        return edge.requires_ids + self.edge_table.depfile_ids[edge.index]
+
+    def _iterate_edges(self, targets):
+        """Edges building 'targets', dependencies first"""
+        id2edge = self.edge_table.id2edge
+        all_inputs = lambda e: self._get_inputs(e) + self.edge_table.order_only_ids[e.index]
+        visited = set()
+        for t in targets:
+            edge = id2edge.get(t)
+            if edge is None or edge.index in visited:
                 continue
+            visited.add(edge.index)
+            stack = [(edge, iter(all_inputs(edge)))]
+            while stack:
+                edge, inputs = stack[-1]
+                for v in inputs:
+                    dep_edge = id2edge.get(v)
+                    if dep_edge is not None and dep_edge.index not in visited:
+                        visited.add(dep_edge.index)
+                        stack.append((dep_edge, iter(all_inputs(dep_edge))))
+                        break
+                else:
+                    stack.pop()
+                    yield edge
+
+    def _is_outdated(self, edge, most_recent, snapshot):
+        """ninja's checks of the outputs of an edge, given the mtime of its most recent input"""
+        paths = self.edge_table.nodes.paths
+        restat = generator = None
+        for out in (paths[i] for i in edge.provides_ids):
+            mtime = snapshot.get_mtime(out)
+            if mtime is None:
+                V2("Dirty, missing output: %s", out)
+                return True
+            entry = self.ninja_log.entries.get(out) if self.ninja_log else None
+            if most_recent is not None and mtime < most_recent:
+                if restat is None:
+                    restat = self._get_flag(edge, 'restat')
+                if not (restat and entry and entry[0] >= most_recent):
+                    V2("Dirty, output older than inputs: %s", out)
+                    return True
+            # Without a build log, ninja finds no output in it
+            if generator is None:
+                generator = self._get_flag(edge, 'generator')
+            if entry is None:
+                if not generator:
+                    V2("Dirty, not in the build log: %s", out)
+                    return True
+                continue
+            if not generator and entry[1] != self._get_command_hash(edge):
+                V2("Dirty, command changed: %s", out)
+                return True
+            if most_recent is not None and entry[0] < most_recent:
+                V2("Dirty, build log entry older than inputs: %s", out)
+                return True
+
+        out = paths[edge.provides_ids[0]]
+        if self._get_flag(edge, 'deps'):
+            deps_mtime = self.deps_log.get_mtime(out) if self.deps_log else None
+            if deps_mtime is None or deps_mtime < snapshot.get_mtime(out):
+                V2("Dirty, deps missing or outdated: %s", out)
+                return True
+        else:
+            depfile = self._get_flag(edge, 'depfile')
+            if depfile and snapshot.get_mtime(os.path.normpath(depfile)) is None:
+                V2("Dirty, depfile missing: %s", out)
+                return True
+        return False
+
+    def predict(self, targets, snapshot=None, changed=None):
+        """
+        Returns indices of the (non-phony) edges building 'targets' which
+        ninja would run, as (dirty, maybe skipped by restat). Without a stat
+        snapshot, the build is assumed up to date but for the 'changed' files.
+        """
+        nodes = self.edge_table.nodes
+        id2edge = self.edge_table.id2edge
+        if snapshot is not None and self.deps_log is None:
+            self.deps_log = self.parser._get_deps_log()
+        changed_ids = set(nodes.get_id(os.path.normpath(p)) for p in changed or ())
+        if targets:
+            target_ids = [i for i in (nodes.get_id(os.path.normpath(t)) for t in targets) if i is not None]
+        else:
+            target_ids = [i for edge in self.edge_table.edges for i in edge.provides_ids]
+        states = dict() # edge index -> state
+        phony_mtimes = dict() # node id -> mtime of a phony output not on disk
+        dirty, maybe = [], []
+        for edge in self._iterate_edges(target_ids):
+            state = self.CLEAN
+            most_recent = None
+            for v in self._get_inputs(edge):
+                dep_edge = id2edge.get(v)
+                dep_state = states.get(dep_edge.index, self.CLEAN) if dep_edge is not None else self.CLEAN
+                if dep_state:
+                    restat = dep_state == self.MAYBE or self._get_flag(dep_edge, 'restat')
+                    state = max(state, self.MAYBE if restat else self.DIRTY)
+                if v in changed_ids:
+                    state = self.DIRTY
+                if snapshot is None:
+                    continue
+                mtime = phony_mtimes.get(v) or snapshot.get_mtime(nodes.paths[v])
+                if mtime is None:
+                    if dep_edge is None:
+                        V2("Dirty, missing input: %s", nodes.paths[v])
+                        state = self.DIRTY
+                    continue
+                if most_recent is None or mtime > most_recent:
+                    most_recent = mtime
+
+            if edge.is_phony:
+                if not self._get_inputs(edge) and not self.edge_table.order_only_ids[edge.index]:
+                    # A phony edge without inputs is dirty while its output is missing,
+                    # whatever changed: stat these few outputs even without a snapshot
+                    for path in (nodes.paths[out] for out in edge.provides_ids):
+                        exists = snapshot.get_mtime(path) is not None if snapshot is not None else os.path.exists(path)
+                        if not exists:
+                            V2("Dirty, missing output of phony edge with no inputs: %s", path)
+                            state = self.DIRTY
+                elif snapshot is not None and most_recent is not None:
+                    for out in edge.provides_ids:
+                        if snapshot.get_mtime(nodes.paths[out]) is None:
+                            phony_mtimes[out] = most_recent
+            elif state != self.DIRTY and snapshot is not None and self._is_outdated(edge, most_recent, snapshot):
+                state = self.DIRTY
+            states[edge.index] = state
+            if edge.is_phony or not state:
+                continue
+            (dirty if state == self.DIRTY else maybe).append(edge.index)
+        return dirty, maybe
+
+def print_dirty_prediction(manifest_parser, edge_table, targets, changed):
+    predictor = DirtyPredictor(manifest_parser, edge_table, load_ninja_log(manifest_parser))
+    started = time.time()
+    snapshot = None
+    if not changed:
+        snapshot = StatSnapshot(edge_table.nodes.paths +
+                                [os.path.normpath(p) for p in
+                                 (predictor._get_flag(e, 'depfile') for e in edge_table.edges) if p])
+    dirty, maybe = predictor.predict(targets, snapshot, changed)
+    V1("Predicted in %.3fs", time.time() - started)
+    paths = edge_table.nodes.paths
+    for i in dirty:
+        V1("dirty: %s", " ".join(paths[v] for v in edge_table.edges[i].provides_ids))
+    for i in maybe:
+        V1("maybe (restat): %s", " ".join(paths[v] for v in edge_table.edges[i].provides_ids))
+    info("Edges to rebuild: %d, and up to %d more unless 'restat' outputs are unchanged", len(dirty), len(maybe))
+    return dirty, maybe
+
+class LintCache(object):
+    """Dependency check results of targets from previous runs, valid as
+    long as the target check key is the same (see _lint_key)."""
+    def __init__(self, path):
+        self.path = path
+        self.results = dict() # (pass, target) -> (key, missing, ignored missing)
+        self.used = dict()
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.results = pickle.load(f)
+            V1("Loaded %d cached check results from: %r", len(self.results), path)
+
+    def get(self, pass_name, target, key):
+        result = self.results.get((pass_name, target))
+        if result is None or result[0] != key:
+            return None
+        self.used[(pass_name, target)] = result
+        return result[1], result[2]
+
+    def put(self, pass_name, target, key, missing, ignored):
+        self.used[(pass_name, target)] = (key, missing, ignored)
+
+    def save(self):
+        # Only results of this run are kept
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.used, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _lint_key(trace_graph, manifest_fingerprints, tp_id, edge_in_trace):
+    # Covers the manifest closure of the target (fingerprint), its trace
+    # record and the configuration inhibiting errors
+    paths = trace_graph.nodes.paths
+    h = hashlib.blake2b(manifest_fingerprints[tp_id], digest_size=16)
+    h.update(repr([(t.pattern, d.pattern) for t, d in _IMPLICIT_DEPS_MATCHERS]).encode())
+    for dep in sorted(paths[i] for i in trace_graph.get_requires_ids(edge_in_trace)):
+        h.update(dep.encode())
+        h.update(b'|s' if trace_graph.is_static_target(dep) else b'|')
+    return h.digest()
+
+def _lint_target(trace_graph, manifest_graph, clean_build, tp):
+    """Returns (missing, ignored missing) dependencies of a target"""
+    # Note: graphs must share the node table, dependencies are compared by node ids
+    paths = manifest_graph.nodes.paths
+    implicit_deps = get_implicit_deps_matcher()
+    missing = []
+    ignored_missing = []
+    candidates = None
+    edge_in_trace = trace_graph.get_edge(tp)
+    tp_id = manifest_graph.nodes.get_id(tp)
+    for dep_id in trace_graph.get_requires_ids(edge_in_trace):
+        if manifest_graph.depends_on_id(tp_id, dep_id):
+            continue
+        dep = paths[dep_id]
+        if clean_build and trace_graph.is_static_target(dep):
+            # Only dependencies on the non-static targets are critical
+            # for a clean build.
+            continue
 
-            if match_implicit_dependency(dep, [tp] + list(manifest_graph.get_deps_closure(tp))):
+        if implicit_deps.get_targets_re(dep) is not None:
+            # The closure is decoded only for dependencies some rule matches
+            if candidates is None:
+                candidates = [tp] + list(manifest_graph.get_deps_closure(tp))
+            if implicit_deps.match(dep, candidates):
                 # The dependency 'tp | deps' IS missing in manifest graph,
                 #  but 'implicit' dependencies rules fix this. Inhibit the warning.
-                ignored_missing[tp].append(dep)
+                ignored_missing.append(dep)
                 continue
-            missing[tp].append(dep)
+        missing.append(dep)
+    return missing, ignored_missing
+
+# Graphs checked by worker processes, inherited from the parent when forked
+_lint_worker_args = None
+
+def _lint_targets_worker(targets):
+    trace_graph, manifest_graph, clean_build = _lint_worker_args
+    return [_lint_target(trace_graph, manifest_graph, clean_build, tp) for tp in targets]
+
+def compare_dependencies(trace_graph, manifest_graph, clean_build, jobs=1, cache=None):
+    """Check traced dependencies of manifest targets against the manifest
+    graph. Targets are checked by 'jobs' forked processes sharing the graphs,
+    targets with results in 'cache' (a LintCache) are not checked again."""
+    targets = []
+    for tp in manifest_graph.iterate_targets_by_rank(include_static_targets=False):
+        if manifest_graph.is_phony_target(tp):
+            V2("Skipping phony: %s", tp)
+            continue
+        if not trace_graph.get_edge(tp):
+            warn("manifest target '%s' doesn't present in strace graph", tp)
+            continue
+        targets.append(tp)
+
+    pass_name = 'clean' if clean_build else 'incremental'
+    results = dict()
+    keys = dict()
+    if cache is not None:
+        fingerprints = manifest_graph.get_fingerprints()
+        for tp in targets:
+            keys[tp] = key = _lint_key(trace_graph, fingerprints, manifest_graph.nodes.get_id(tp),
+                                       trace_graph.get_edge(tp))
+            result = cache.get(pass_name, tp, key)
+            if result is not None:
+                results[tp] = result
+        V1("Targets unchanged since the last run (not checked again): %d of %d", len(results), len(targets))
+    todo = [tp for tp in targets if tp not in results]
+
+    if jobs > 1 and len(todo) > _LINT_CHUNK:
+        V1("Checking %d targets in %d processes...", len(todo), jobs)
+        global _lint_worker_args
+        _lint_worker_args = (trace_graph, manifest_graph, clean_build)
+        chunks = [todo[i:i + _LINT_CHUNK] for i in range(0, len(todo), _LINT_CHUNK)]
+        flush_log()
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+                checked = [r for chunk in pool.map(_lint_targets_worker, chunks) for r in chunk]
+        finally:
+            _lint_worker_args = None
+    else:
+        checked = [_lint_target(trace_graph, manifest_graph, clean_build, tp) for tp in todo]
+    results.update(zip(todo, checked))
+
+    missing = defaultdict(list)
+    ignored_missing = defaultdict(list)
+    for tp in targets:
+        tp_missing, tp_ignored = results[tp]
+        if cache is not None:
+            cache.put(pass_name, tp, keys[tp], tp_missing, tp_ignored)
+        if tp_missing:
+            missing[tp] = tp_missing
+        if tp_ignored:
+            ignored_missing[tp] = tp_ignored
     return missing, ignored_missing
 
 def print_excessive_manifest_dependencies(manifest_graph, trace_graph):
+    # Note: graphs must share the node table
     manifest_targets = set(manifest_graph.target_deps_closure.keys())
     traced_targets = set(trace_graph.target_deps_closure.keys())
     excessive_by_targets = defaultdict(list)
-    for x in sorted(manifest_targets - traced_targets):
-        if ninja_incremental_graph.is_phony_target(x):
+    parents = manifest_graph.get_top_parents()
+    paths = manifest_graph.nodes.paths
+    for x in sorted(manifest_targets - traced_targets, key=paths.__getitem__):
+        if manifest_graph.is_phony_target(paths[x]) or parents.get(x) is None:
+            # Top targets have no parent to depend excessively
             continue
-        path_to_top = manifest_graph.get_any_path_to_top(x)
-        immediate_parent = path_to_top[0]
-        excessive_by_targets[immediate_parent].append(x)
+        excessive_by_targets[paths[parents[x]]].append(paths[x])
 
     if not excessive_by_targets:
         info("No issues!")
         return []
 
-    warn("Targets with excessive dependenies: %d" % len(excessive_by_targets))
-    for t in manifest_graph.sorted_by_products_num(list(excessive_by_targets.keys()), reverse=True):
-        deps = excessive_by_targets[t]
-        V1("%s (%d excessive deps): %r {> '%s'}" % (t, len(deps), deps, "' > '".join(path_to_top)))
+    warn("Targets with excessive dependenies: %d", len(excessive_by_targets))
+    if _verbose >= 1:
+        for t in manifest_graph.sorted_by_products_num(list(excessive_by_targets.keys()), reverse=True):
+            deps = excessive_by_targets[t]
+            path_to_top = [t] + manifest_graph.get_any_path_to_top(t)
+            V1("%s (%d excessive deps): %r {> '%s'}", t, len(deps), deps, "' > '".join(path_to_top))
     return excessive_by_targets
 
 def print_missing_dependencies(manifest_graph, missing, ignored_missing, clean_build):
     dtype="ORDER " if clean_build else ""
     for t, t_deps in missing.items():
-        error("target '%s' is missing %sdependencies on: %r" % (t, dtype, t_deps))
+        error("target '%s' is missing %sdependencies on: %r", t, dtype, t_deps)
         #TODO: print path from t to top in verbose mode?
 
     if ignored_missing:
-        warn("%sDependency errors inhibited for %d targets due to implicit dependency rules" % (dtype, len(ignored_missing)))
+        warn("%sDependency errors inhibited for %d targets due to implicit dependency rules", dtype, len(ignored_missing))
     for t, t_ignored_deps in ignored_missing.items():
-        V1("Ignoring missing %sdependencies of '%s' on %r" % (dtype, t, t_ignored_deps))
+        V1("Ignoring missing %sdependencies of '%s' on %r", dtype, t, t_ignored_deps)
         #TODO: print path from t to top in verbose mode?
 
 def print_targets_by_ranks(graph):
     for rank in sorted(list(graph.targets_by_ranks.keys()), reverse=True):
         lst = ", ".join(graph.targets_by_ranks[rank])
-        V0("Rank %2d: %5d targets) [%s]" % (rank, len(graph.targets_by_ranks[rank]), lst))
+        V0("Rank %2d: %5d targets) [%s]", rank, len(graph.targets_by_ranks[rank]), lst)
 
-def print_targets_by_depending_products(graph):
+def load_ninja_log(manifest_parser):
+    path = os.path.join(manifest_parser.global_attributes.get('builddir', ''), _NINJA_LOG)
+    if not os.path.isfile(path):
+        V1("No ninja log at %r, edge durations unknown", path)
+        return None
+    try:
+        ninja_log = NinjaLogParser(path)
+    except Exception as e:
+        warn("Ninja log %r couldn't be read (%s), edge durations unknown", path, e)
+        return None
+    V1("Loaded %d edge durations from ninja log: %r", len(ninja_log.durations), path)
+    return ninja_log
+
+def get_edge_durations(graph, ninja_log=None):
+    """
+    Returns durations of the wanted edges of 'graph' (in seconds, indexed by
+    edge index, 0 for phony and unwanted edges) from 'ninja_log'. Edges not
+    in the log take the mean duration of the known ones; without a log every
+    edge takes 1 (profiles are then in edges rather than seconds).
+    """
+    durations = [0.0] * len(graph.edges)
+    unknown = []
+    for edge in graph.edges:
+        if edge.is_phony or not graph._is_wanted(edge):
+            continue
+        d = ninja_log.get_edge_duration(graph.get_provides(edge)) if ninja_log else None
+        if d is None:
+            unknown.append(edge.index)
+        else:
+            durations[edge.index] = d
+    known = sum(1 for edge in graph.edges if not edge.is_phony and graph._is_wanted(edge)) - len(unknown)
+    default = sum(durations) / known if known else 1.0
+    for i in unknown:
+        durations[i] = default
+    return durations
+
+class ParallelismProfile(object):
+    """
+    Parallelism of the wanted part of a graph, given its edge durations:
+     - edges (non-phony) and work (summary duration) per rank,
+     - critical path: the longest chain of edges, the best possible build time,
+     - peak jobs: most edges running at once when starting each edge as soon
+       as its dependencies are done, i.e., the max useful '-j',
+     - funnels: ranks at most _FUNNEL_WIDTH wide, serializing the build.
+    """
+    _FUNNEL_WIDTH = 1
+
+    def __init__(self, graph, durations):
+        self.graph = graph
+        self.durations = durations
+        self.rank_edges = defaultdict(list)
+        for edge in graph.edges:
+            rank = graph.get_edge_rank(edge)
+            if rank is not None and not edge.is_phony:
+                self.rank_edges[rank].append(edge)
+        self.work = sum(durations)
+        self.edge_finish = dict() # edge index -> finish time with unlimited jobs
+        self.critical_path = self._calc_critical_path()
+        self.critical_length = self.edge_finish[self.critical_path[-1].index] if self.critical_path else 0.0
+        self.peak_jobs = self._calc_peak_jobs()
+        max_width = max((len(e) for e in self.rank_edges.values()), default=0)
+        self.funnels = [rank for rank in sorted(self.rank_edges)
+                        if len(self.rank_edges[rank]) <= self._FUNNEL_WIDTH < max_width]
+
+    def get_average_parallelism(self):
+        return self.work / self.critical_length if self.critical_length else 0.0
+
+    def _calc_critical_path(self):
+        graph = self.graph
+        finish = dict() # node id -> finish time of its edge
+        critical_pred = dict() # edge index -> the last finishing edge it waits for
+        for component in graph.components_order:
+            for v in component:
+                edge = graph.id2edge.get(v)
+                if edge is None:
+                    finish[v] = 0.0
+                    continue
+                t = self.edge_finish.get(edge.index)
+                if t is None:
+                    start, pred = 0.0, None
+                    for w in graph.get_requires_ids(edge):
+                        # Dependencies in loops are not finished yet
+                        if finish.get(w, 0.0) > start:
+                            start, pred = finish[w], w
+                    t = self.edge_finish[edge.index] = start + self.durations[edge.index]
+                    if pred is not None:
+                        critical_pred[edge.index] = graph.id2edge[pred]
+                finish[v] = t
+        if not self.edge_finish:
+            return []
+        edge = graph.edges[max(self.edge_finish, key=self.edge_finish.get)]
+        path = []
+        while edge is not None:
+            if not edge.is_phony:
+                path.append(edge)
+            edge = critical_pred.get(edge.index)
+        path.reverse()
+        return path
+
+    def _calc_peak_jobs(self):
+        events = []
+        for i, t in self.edge_finish.items():
+            if self.durations[i] > 0:
+                events.append((t - self.durations[i], 1))
+                events.append((t, -1))
+        # Edges finishing free their job before others start at the same time
+        events.sort()
+        jobs = peak = 0
+        for _, delta in events:
+            jobs += delta
+            peak = max(peak, jobs)
+        return peak
+
+def print_parallelism_profile(graph, durations, timed):
+    unit = "s" if timed else " units"
+    profile = ParallelismProfile(graph, durations)
+    info("Work: %.1f%s in %d edges, critical path: %.1f%s in %d edges",
+         profile.work, unit, sum(len(e) for e in profile.rank_edges.values()),
+         profile.critical_length, unit, len(profile.critical_path))
+    info("Average parallelism (work / critical path): %.1f, max useful -j: %d",
+         profile.get_average_parallelism(), profile.peak_jobs)
+    for rank in sorted(profile.rank_edges.keys(), reverse=True):
+        edges = profile.rank_edges[rank]
+        V0("Rank %2d: width %5d, work %10.1f%s%s", rank, len(edges),
+           sum(durations[e.index] for e in edges), unit, " (funnel)" if rank in profile.funnels else "")
+    V1("Critical path: %s", " > ".join(" ".join(graph.get_provides(e)) for e in profile.critical_path))
+    if profile.funnels:
+        warn("Funnel ranks serializing the build: %d", len(profile.funnels))
+    for rank in profile.funnels:
+        for edge in profile.rank_edges[rank]:
+            outputs = graph.get_provides(edge)
+            V0("Rank %2d: %10.1f%s, %5d edges waiting%s: %s", rank, durations[edge.index], unit,
+               graph.get_edge_products_num(edge),
+               ", on critical path" if edge in profile.critical_path else "", " ".join(outputs))
+    return profile
+
+def print_targets_by_depending_products(graph, top=10):
     static_wanted_sources = graph.targets_by_ranks[0]
-    nonstatic_wanted_rules = list(e for e in graph.target2edge.values() if e.rank)
+    nonstatic_wanted_rules_num = sum(1 for rank in graph.edge_ranks if rank) or 1
+    scored = [(t, graph.get_products_num(t)) for t in static_wanted_sources]
     bins = [list() for x in range(0,10)]
-    for t in graph.sorted_by_products_num(static_wanted_sources, reverse=True):
-        score = len(graph.get_product_rules_closure(t))
-        prct = score*100.0/len(nonstatic_wanted_rules)
-        bin = int(prct / 10)
+    for t, score in scored:
+        prct = score*100.0/nonstatic_wanted_rules_num
+        bin = min(int(prct / 10), 9)
         bins[bin].append((t, score, prct))
-        V2("%5d (%2.0f%%): %r" % (score, prct, t))
+        V2("%5d (%2.0f%%): %r", score, prct, t)
+    V0("Most impactful sources:")
+    for t, score in graph.most_impactful_sources(top, scored):
+        V0("%5d (%2.0f%%): %r", score, score*100.0/nonstatic_wanted_rules_num, t)
     for i, bin in enumerate(bins):
         if not bin:
             continue
-        V0("[%2d-%2d%%]: %5d targets [%s]" % (
-            10*i, 10*i+10, len(bin),
-            ", ".join("%s(%d%%)" % (b[0], b[2]) for b in bin)))
+        V0("[%2d-%2d%%]: %5d targets [%s]",
+           10*i, 10*i+10, len(bin),
+           ", ".join("%s(%d%%)" % (b[0], b[2]) for b in bin))
     return bins
 
 if __name__ == '__main__':
@@ -768,11 +1955,26 @@ if __name__ == '__main__':
     parser.add_argument('-f', dest='manifest', default=_DEFAULT_MANIFEST, help='specify input ninja manifest')
     parser.add_argument('-r', dest='tracefile', default=_DEFAULT_TRACEFILE, help='specify input trace file')
     parser.add_argument('--conf', help='load custom configuration from CONF')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='run N jobs in parallel (loading depfiles, checking targets)')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache parsed depfiles and check results in %s and %s'
+                        ' to check only changed targets in the next runs' % (_DEPFILES_CACHE, _LINT_CACHE))
     parser.add_argument('--stats', choices=['all'], help='Evaluate and print build tree statitics')
+    parser.add_argument('--dirty', action='store_true',
+                        help='predict the edges ninja would rebuild and exit: from the files mtimes,'
+                        ' or assuming an up to date build but for the --changed files if given')
+    parser.add_argument('--changed', action='append', default=[], metavar='FILE',
+                        help='with --dirty, FILE changed since the last build (may be repeated)')
+    parser.add_argument('--restat', nargs='+', metavar='HASHES',
+                        help='find restat candidates from outputs hashes snapshots of consecutive'
+                        ' traced builds (see strace_ninja.py --hash-outputs)')
     parser.add_argument('-v', dest='verbose', action='count', default=0, help='increase verbosity level')
     parser.add_argument('--version', action='version', version='%(prog)s: git')
     parser.add_argument('targets', nargs='*', help='specify targets to verify, as passed to ninja when traced')
     args = parser.parse_args()
+    if args.changed and not args.dirty:
+        parser.error("--changed requires --dirty")
 
     # Set global verbosity level
     _verbose = args.verbose
@@ -780,7 +1982,7 @@ if __name__ == '__main__':
 
     # Process "-C"
     if args.dir:
-        V1("Changing working dir to: %r" % args.dir)
+        V1("Changing working dir to: %r", args.dir)
         os.chdir(args.dir)
 
     # TODO: validate files existence (manifest, traces & config)
@@ -790,7 +1992,7 @@ if __name__ == '__main__':
     # With custom 'IGNORED_SUFFICES' and 'IMPLICIT_DEPS_MATCHERS' lists
     if args.conf:
         if load_config(args.conf) is None:
-            fatal("Couldn't load configuration file: %r" % args.conf)
+            fatal("Couldn't load configuration file: %r", args.conf)
     else:
         config_path = os.path.join(os.path.dirname(args.manifest), _DEPSLINT_CFG)
         load_config(config_path)
@@ -798,11 +2000,24 @@ if __name__ == '__main__':
     ### Parsing inputs
     info("Parsing Ninja manifest..")
     manifest_file = open(args.manifest, "r")
-    ninja_parser = NinjaManifestParser(manifest_file)
+    # Predicting the rebuild of a few targets needs only their depfiles
+    lazy_depfiles = args.dirty and bool(args.targets)
+    ninja_parser = NinjaManifestParser(manifest_file, jobs=args.jobs, lazy_depfiles=lazy_depfiles,
+                                       depfiles_cache=_DEPFILES_CACHE if args.cache else None)
     wanted = args.targets or ninja_parser.get_default_targets()
+    if lazy_depfiles:
+        V1("Loaded depfiles of the %d edges building: %s",
+           ninja_parser.load_targets_depfiles(wanted), " ".join(wanted))
+    ninja_parser.depfile_loader.save(prune=not lazy_depfiles)
     ### Build graphs
-    ninja_clean_build_graph = create_graph(args.manifest, ninja_parser, wanted, clean_build_graph=True)
-    ninja_incremental_graph = create_graph(args.manifest, ninja_parser, wanted, clean_build_graph=False)
+    # All graphs share the node table, manifest graphs share the edges too
+    nodes = NodeTable()
+    manifest_edges = EdgeTable(ninja_parser.iterate_target_rules(), nodes)
+    if args.dirty:
+        print_dirty_prediction(ninja_parser, manifest_edges, wanted, args.changed)
+        sys.exit(0)
+    ninja_clean_build_graph = create_graph(args.manifest, manifest_edges, wanted, clean_build_graph=True)
+    ninja_incremental_graph = create_graph(args.manifest, manifest_edges, wanted, clean_build_graph=False)
     manifest_file.close()
 
     info("Parsing Trace log..")
@@ -810,15 +2025,17 @@ if __name__ == '__main__':
     trace_parser = TraceParser(trace_file)
 
     # # Note: for now, always build a complete (e.g., all-targets-wanted) trace-graph
-    trace_graph = create_graph(args.tracefile, trace_parser, targets=[])
+    trace_graph = create_graph(args.tracefile, EdgeTable(trace_parser.iterate_target_rules(), nodes), targets=[])
 
     ### Verification passes
     H0()
     info("=== Pass #1: checking clean build order constraints ===")
     info("=== (may lead to clean build failure or, rarely, to incorrect builds) ===")
-    missing, ignored = compare_dependencies(trace_graph, ninja_clean_build_graph, clean_build=True)
+    lint_cache = LintCache(_LINT_CACHE) if args.cache else None
+    missing, ignored = compare_dependencies(trace_graph, ninja_clean_build_graph, clean_build=True,
+                                            jobs=args.jobs, cache=lint_cache)
     if missing or ignored:
-        info("Errors: %d, Ignored: %d" % (len(missing), len(ignored)))
+        info("Errors: %d, Ignored: %d", len(missing), len(ignored))
         print_missing_dependencies(ninja_clean_build_graph, missing, ignored, clean_build=True)
     else:
         info("No issues!")
@@ -826,12 +2043,24 @@ if __name__ == '__main__':
     H0()
     info("=== Pass #2: checking for missing dependencies ===")
     info("=== (may lead to incomlete incremental builds if any) ===")
-    missing, ignored = compare_dependencies(trace_graph, ninja_incremental_graph, clean_build=False)
+    missing, ignored = compare_dependencies(trace_graph, ninja_incremental_graph, clean_build=False,
+                                            jobs=args.jobs, cache=lint_cache)
     if missing or ignored:
-        info("Errors: %d, Ignored: %d" % (len(missing), len(ignored)))
+        info("Errors: %d, Ignored: %d", len(missing), len(ignored))
         print_missing_dependencies(ninja_incremental_graph, missing, ignored, clean_build=False)
     else:
         info("No issues!")
+    if lint_cache is not None:
+        lint_cache.save()
+
+    if args.restat:
+        H0()
+        info("=== Restat candidates ===")
+        info("=== (rules rewriting outputs byte-identical, triggering needless rebuilds) ===")
+        if len(args.restat) < 2:
+            fatal("At least two outputs hashes snapshots are needed to find restat candidates")
+        snapshots = [load_output_hashes(path) for path in args.restat]
+        print_restat_candidates(find_restat_candidates(snapshots, ninja_incremental_graph, ninja_parser))
 
     ### Statistics passes
     if args.stats:
@@ -847,10 +2076,10 @@ if __name__ == '__main__':
         info("=== Targets rank histograms ===")
         info("=== ('rank' is target distance from the bottom of the graph) ===")
         info("=== (e.g., a minimal number of sequential tasks to rebuild a target) ===")
-        V0("=== Targets from '%s' by order-dependencies rank ===" % args.manifest)
+        V0("=== Targets from '%s' by order-dependencies rank ===", args.manifest)
         print_targets_by_ranks(ninja_clean_build_graph)
 
-        V0("=== Targets from '%s' by rebuild-dependencies rank ===" % args.manifest)
+        V0("=== Targets from '%s' by rebuild-dependencies rank ===", args.manifest)
         print_targets_by_ranks(ninja_incremental_graph)
 
         V0("=== Targets from TRACE by rank ===")
@@ -861,10 +2090,17 @@ if __name__ == '__main__':
         # warn("Detected multiple rules modifying targets:")
         # print trace_graph.duplicate_target_rules()
 
+        H0()
+        info("=== Build parallelism profile ===")
+        info("=== (a clean build with unlimited jobs, edge durations from %s if any) ===", _NINJA_LOG)
+        ninja_log = load_ninja_log(ninja_parser)
+        print_parallelism_profile(ninja_clean_build_graph,
+                                  get_edge_durations(ninja_clean_build_graph, ninja_log), timed=bool(ninja_log))
+
         H0()
         info("=== Targets by number of products ===")
         info("=== (e.g., how many targets are rebuilt if 'x' is touched) ===")
-        # print_targets_by_depending_products(ninja_incremental_graph)
+        print_targets_by_depending_products(ninja_incremental_graph)
 
     info("=== That's all! ===")
     sys.exit(0)
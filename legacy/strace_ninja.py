@@ -21,21 +21,37 @@
 # 3. Call ninja with strace in the build folder:
 #    strace -ostrace_log -f -a1 -s0 -etrace=file,process -esignal=none ninja -d keepdepfile -C build/host_c66/
 #    Note: -> strace_log could be more than 1gb!
+#    Add '-ttt -T' to the strace options to get a '--timing' report.
 # 4. Parse the output log
 #   strace.py -v -r strace_log
 
 
+import functools
+import hashlib
+import json
 import optparse
 import os
 import re
 import subprocess
 import sys
+from collections import defaultdict
 #import tempfile
 
 _NINJA_PROG_NAME = 'ninja'
 _DEFAULT_OUTFILE = 'deps.lst'
 _STRACE_LOG = 'strace_log.txt'
 _STRACE_FIFO = f'/tmp/_strace_log_fifo' # TODO: use tempfile
+_TRACE_FORMAT = 'depstrace'
+_TRACE_FORMAT_VERSION = 1
+_HASHES_FORMAT = 'depstrace-hashes'
+_HASHES_FORMAT_VERSION = 1
+_NORM_PATH_CACHE_SIZE = 1 << 16 # (cwd, path) pairs
+
+# 'strace -r' timestamps are relative to the previous syscall, 'strace -ttt' ones
+# are seconds since epoch. Tell these apart by the first timestamp value.
+_RELATIVE_TIMESTAMP_LIMIT = 1e6
+# Syscalls blocking on child processes, not accounted as the process' syscall time
+_WAIT_OPS = ('wait4', 'waitpid')
 
 _FILEOPS=r'open|openat|(sym)?link|rename|chdir|creat' # TODO: handle |openat?
 _PROCOPS=r'clone|execve|v?fork'
@@ -50,58 +66,104 @@ _OPS = '%s|%s|%s' % (_FILEOPS, _PROCOPS, _UNUSED)
 global _verbose
 _verbose = 0
 
-def V0(*strings):
+# Messages are formatted as 'msg % args' only when printed. Per strace line
+# calls also check the level first, so that quiet runs pay nothing for them.
+def V0(msg, *args):
     if _verbose >= 0:
-        print(" ".join(strings))
+        print(msg % args if args else msg)
 
-def V1(*strings):
+def V1(msg, *args):
     if _verbose >= 1:
-        print(" ".join(strings))
+        print(msg % args if args else msg)
 
-def V2(*strings):
+def V2(msg, *args):
     if _verbose >= 2:
-        print(" ".join(strings))
+        print(msg % args if args else msg)
 
-def V3(*strings):
+def V3(msg, *args):
     if _verbose >= 3:
-        print(" ".join(strings))
+        print(msg % args if args else msg)
 
-def fatal(msg, ret=-1):
+def fatal(msg, *args, ret=-1):
     if _verbose < 0:
         return
     sys.stdout.flush()
-    msg = "FATAL: %s" % msg
+    msg = "FATAL: %s" % (msg % args if args else msg)
     print("\033[1;41m%s\033[0m" % msg, file=sys.stderr)
     sys.exit(ret)
 
-def warn(msg):
+def warn(msg, *args):
     if _verbose < 0:
         return
-    print("\033[1;33mWARNING: %s\033[0m" % msg)
+    print("\033[1;33mWARNING: %s\033[0m" % (msg % args if args else msg))
 
-def info(msg):
+def info(msg, *args):
     if _verbose < 0:
         return
-    print("\033[1;32mINFO: %s\033[0m" % msg)
+    print("\033[1;32mINFO: %s\033[0m" % (msg % args if args else msg))
+
+class TracedProcess(object):
+    """Timing of a single process (compiler driver, cc1plus, as, ld, ...) of a rule"""
+    def __init__(self, pid, tool):
+        self.pid = pid
+        self.tool = tool
+        self.start = None
+        self.end = None
+        self.syscall_time = 0.0
+
+    def account(self, time, duration):
+        if self.start is None:
+            self.start = time
+        self.end = max(self.end if self.end is not None else time, time + duration)
+        self.syscall_time += duration
+
+    def get_wall_time(self):
+        if self.start is None:
+            return 0.0
+        return self.end - self.start
 
 class TracedRule(object):
+    """Dependencies and outputs of a rule, as path ids interned by DepsTracer"""
     def __init__(self, lineno):
         self.deps = set()
         self.outputs = set()
+        self.processes = list()
+
+        # Header search analysis: read opens, failed ones in the order attempted
+        self.lookups = set()
+        self.lookup_misses = list()
 
         # Debug info
         self.pids = set()
         self.lineno = lineno
 
-    def add_dep(self, path):
-        self.deps.add(path)
+    def add_dep(self, path_id):
+        self.deps.add(path_id)
+
+    def add_output(self, path_id):
+        self.outputs.add(path_id)
+
+    def add_lookup(self, path_id):
+        self.lookups.add(path_id)
 
-    def add_output(self, path):
-        self.outputs.add(path)
+    def add_lookup_miss(self, path_id):
+        self.lookup_misses.append(path_id)
 
     def add_pid(self, pid):
         self.pids.add(pid)
 
+    def add_process(self, process):
+        self.processes.append(process)
+
+    def get_wall_time(self):
+        timed = [p for p in self.processes if p.start is not None]
+        if not timed:
+            return 0.0
+        return max(p.end for p in timed) - min(p.start for p in timed)
+
+    def get_syscall_time(self):
+        return sum(p.syscall_time for p in self.processes)
+
     def get_deps_filtered(self):
         # Complex scripts may create intermediate outputs and then
         # reconsume these as inputs, therefore we don't consider modifed
@@ -118,8 +180,11 @@ class DepsTracer(object):
     # Regular expressions for parsing syscall in strace log
     # TODO: this is VERY slow. We can easily improve this if anyone cares...
     _file_re = re.compile(r'(?P<pid>\d+)\s+' +
+                          r'(?:[\d:.]+\s+)?' + # optional '-tt', '-ttt' or '-r' timestamp
                           r'(?P<op>%s)\(' % _OPS +
-                          r'(?P<arg>[\s\w\d\-\{\}\=\|\/\*\?\,\.\"\[\]\&\+]*)\) = (?P<ret>-?\d+|\?)')
+                          # parentheses for wait statuses: [{WIFEXITED(s) && WEXITSTATUS(s) == 0}]
+                          r'(?P<arg>[\s\w\d\-\{\}\=\|\/\*\?\,\.\"\[\]\&\+\(\)]*)\) = (?P<ret>-?\d+|\?)' +
+                          r'(?:.*<(?P<duration>\d+\.\d+)>\s*$)?') # optional '-T' syscall duration
     # _file_re = re.compile(r'(?P<pid>\d+)\s+' +
     #                       r'(?P<op>%s)\(' % _OPS +
     #                       r'(?P<arg1>%s)?(, (?P<arg2>%s))?(, (%s))*' % (_ARG,_ARG,_ARG) +
@@ -127,9 +192,12 @@ class DepsTracer(object):
 
     # Regular expressions for joining interrupted lines in strace log
     _unfinished_re = re.compile(r'(?P<body>(?P<pid>\d+).*)\s+<unfinished \.\.\.>$')
-    _resumed_re   = re.compile(r'(?P<pid>\d+)\s+<\.\.\. \S+ resumed>(?P<body>.*)')
+    _resumed_re   = re.compile(r'(?P<pid>\d+)\s+(?:[\d:.]+\s+)?<\.\.\. \S+ resumed>(?P<body>.*)')
 
-    def __init__(self, build_dir=None, strict=False):
+    # Regular expression for the optional timestamp following the pid
+    _time_re = re.compile(r'\d+\s+(?P<time>\d+(?::\d+:\d+)?\.\d+)\s')
+
+    def __init__(self, build_dir=None, strict=False, track_misses=False):
         self._test_strace_version()
         self.build_dir = os.path.abspath(build_dir or os.getcwd())
         self.logfile = None
@@ -137,16 +205,59 @@ class DepsTracer(object):
         self.traced_rules = list()
         self.cur_lineno = 0
         self.pid2rule = dict()     # pid -> TracedRule (many to one is allowed)
+        self.pid2process = dict()  # pid -> TracedProcess
         self.working_dirs = dict() # pid -> cwd
         self.strict = False
+        self.track_misses = track_misses # record read opens, including failed ones
+
+        # Timing of the current syscall, set if the log has timestamps: the time of
+        # the current line, and the start of the syscall (earlier if it was interrupted)
+        self.cur_time = None
+        self.cur_start = None
+        self.cur_duration = 0.0
+        self._relative_timestamps = None
+
+        # Compilers open the same headers over and over, so paths are normalized,
+        # interned and classified once per (cwd, path) pair
+        self.paths = list()             # path id -> normalized path
+        self.path_ids = dict()          # normalized path -> path id
+        self.path_in_buildtree = list() # path id -> bool
+        self.path_id = functools.lru_cache(maxsize=_NORM_PATH_CACHE_SIZE)(self._intern_path)
 
     def createRule(self, pid):
         r = TracedRule(self.cur_lineno)
         r.add_pid(pid)
         self.traced_rules.append(r)
         self.pid2rule[pid] = r
+        self.createProcess(pid, r, tool=_NINJA_PROG_NAME)
         return r
 
+    def createProcess(self, pid, rule, tool):
+        p = TracedProcess(pid, tool)
+        rule.add_process(p)
+        self.pid2process[pid] = p
+        return p
+
+    def _parse_timestamp(self, timestamp):
+        if ':' in timestamp:
+            # '-tt': wall clock time of day
+            hours, minutes, seconds = timestamp.split(':')
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        time = float(timestamp)
+        if self._relative_timestamps is None:
+            self._relative_timestamps = time < _RELATIVE_TIMESTAMP_LIMIT
+        if self._relative_timestamps:
+            # '-r': time passed since the previous line
+            return (self.cur_time or 0.0) + time
+        return time
+
+    def _account_time(self, pid, op):
+        if self.cur_start is None:
+            return
+        process = self.pid2process.get(pid)
+        if process:
+            process.account(self.cur_start, 0.0 if op in _WAIT_OPS else self.cur_duration)
+
     def norm_path(self, cwd, path):
         path = os.path.join(cwd, path)
         path = os.path.normpath(path)
@@ -158,19 +269,38 @@ class DepsTracer(object):
 
         return path
 
-    def add_dep(self, pid, path):
-        if not self._is_in_buildtree(path):
+    def _intern_path(self, cwd, path):
+        path = self.norm_path(cwd, path)
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.path_in_buildtree.append(self._is_in_buildtree(path))
+        return path_id
+
+    def add_dep(self, pid, path_id):
+        if not self.path_in_buildtree[path_id]:
             return
         rule = self.pid2rule.get(pid)
         if rule:
-            rule.add_dep(path)
+            rule.add_dep(path_id)
 
-    def add_output(self, pid, path):
-        if not self._is_in_buildtree(path):
+    def add_output(self, pid, path_id):
+        if not self.path_in_buildtree[path_id]:
             return
         rule = self.pid2rule.get(pid)
         if rule:
-            rule.add_output(path)
+            rule.add_output(path_id)
+
+    def add_lookup(self, pid, path_id):
+        rule = self.pid2rule.get(pid)
+        if rule:
+            rule.add_lookup(path_id)
+
+    def add_lookup_miss(self, pid, path_id):
+        rule = self.pid2rule.get(pid)
+        if rule:
+            rule.add_lookup_miss(path_id)
 
     def _is_in_buildtree(self, norm_path):
         # All paths which are in build tree were converted to relative by here
@@ -205,9 +335,10 @@ class DepsTracer(object):
                        '-f',  # Follow child processes
                        '-a1', # Only one space before return values
                        '-s0', # Print non-filename strings really short to keep parser simpler
+                       '-ttt', '-T', # Timestamp syscalls and their duration for the timing report
                        '-etrace=file,process', # Trace syscals related to file and process operations (*)
                        '-esignal=none'] + cmd
-            V1("Running: %r" % command)
+            V1("Running: %r", command)
 
             strace_popen = subprocess.Popen(command)
             #rules = self.parse_trace(file(fifopath))
@@ -230,7 +361,7 @@ class DepsTracer(object):
                 path = os.path.normpath(args[0]).strip('"')
                 if path.endswith(_NINJA_PROG_NAME):
                     ninja_pid = pid
-                    V1("detected ninja process invocation: '%s'" % self.cur_line.strip())
+                    V1("detected ninja process invocation: '%s'", self.cur_line.strip())
                     break
         if ninja_pid is None:
             print("Ninja ('%s') process invocation could not be detected" % _NINJA_PROG_NAME, file=sys.stderr)
@@ -243,53 +374,64 @@ class DepsTracer(object):
             arg1 = args[0]
             arg2 = args[1] if len(args) > 1 else ""
             arg3 = args[2] if len(args) > 2 else ""
-            # Ignore failed syscalls
+            self._account_time(pid, op)
+            cwd = self.working_dirs.get(pid, os.getcwd())
+            # Ignore failed syscalls, but failed opens for the header search analysis
             if ret  == '-1':
+                if self.track_misses and op in ('open', 'openat'):
+                    self.add_lookup_miss(pid, self.path_id(cwd, arg1 if op == 'open' else arg2))
                 continue
 
             # Process successful system calls
-            cwd = self.working_dirs.get(pid, os.getcwd())
             if op in ('clone', 'fork', 'vfork') and ret  != '?':
                 new_pid = ret
                 self.working_dirs[new_pid] = cwd
                 # Consider all processes forked by ninja directly a 'build rule' process tree
                 if pid == ninja_pid:
-                    V2("Creating a build rule record for pid %s, line %d in strace log" % (new_pid, self.cur_lineno))
+                    V2("Creating a build rule record for pid %s, line %d in strace log", new_pid, self.cur_lineno)
                     self.createRule(new_pid)
                 else:
                     rul = self.pid2rule.get(pid)
                     rul.add_pid(new_pid)
                     self.pid2rule[new_pid] = rul
+                    self.createProcess(new_pid, rul, tool=self.pid2process[pid].tool)
             elif op == 'chdir':
                 new_cwd = os.path.join(cwd, arg1)
                 self.working_dirs[pid] = new_cwd
             elif op == 'open':
-                path = self.norm_path(cwd, arg1)
+                path = self.path_id(cwd, arg1)
                 mode = arg2
                 if 'O_DIRECTORY' in mode:
                     # Filter out 'opendir'-s.TBD: does this test worth the cycles?
                     continue
                 if 'O_RDONLY' in mode:
                     self.add_dep(pid, path)
+                    if self.track_misses:
+                        self.add_lookup(pid, path)
                 else:
                     self.add_output(pid, path)
             elif op == 'openat':
                 # TODO: check path rel or abs
-                path = self.norm_path(cwd, arg2)
+                path = self.path_id(cwd, arg2)
                 mode = arg3
                 if 'O_RDONLY' and 'O_NOCTTY' in mode:
                     self.add_dep(pid, path)
+                    if self.track_misses:
+                        self.add_lookup(pid, path)
                 else:
                     self.add_output(pid, path)
             elif op == 'execve':
-                path = self.norm_path(cwd, arg1)
+                path = self.path_id(cwd, arg1)
                 self.add_dep(pid, path)
+                process = self.pid2process.get(pid)
+                if process:
+                    process.tool = os.path.basename(arg1)
             elif op == 'symlink':
-                path = self.norm_path(cwd, arg2)
+                path = self.path_id(cwd, arg2)
                 self.add_output(pid, path)
             elif op in ('rename', 'link'):
-                from_path = self.norm_path(cwd, arg1)
-                to_path = self.norm_path(cwd, arg2)
+                from_path = self.path_id(cwd, arg1)
+                to_path = self.path_id(cwd, arg2)
                 self.add_dep(pid, from_path)
                 self.add_output(pid, to_path)
 
@@ -297,20 +439,25 @@ class DepsTracer(object):
 
     def _on_parsing_error(self, msg, line=None):
         line = line or self.cur_line
-        warn("Strace output parsing error: %r" % msg)
-        V0("........ %r @line: %d)" % (line, self.cur_lineno))
+        warn("Strace output parsing error: %r", msg)
+        V0("........ %r @line: %d)", line, self.cur_lineno)
         if self.strict:
             fatal("terminating due to a parsing error in strict mode")
         V0("........ (tracer output may be incomplete)")
         self.unmatched_lines.append(line.strip())
 
     def _strace_log_iter(self, strace_log):
-        interrupted_syscalls = {} # pid -> interrupted syscall log beginning
+        interrupted_syscalls = {} # pid -> (interrupted syscall log beginning, its time)
         for self.cur_lineno, line in enumerate(strace_log, start=1):
             self.cur_line = line
             if self.logfile:
                 self.logfile.write(line)
 
+            match = self._time_re.match(line)
+            if match:
+                self.cur_time = self._parse_timestamp(match.group('time'))
+            self.cur_start = self.cur_time
+
             # Join unfinished syscall traces to a single line
             match = self._unfinished_re.match(line)
             if match:
@@ -318,7 +465,7 @@ class DepsTracer(object):
                 if pid in interrupted_syscalls:
                     self._on_parsing_error("unexpected unfinished syscall")
                     # Replacing the previous 'unfinished'
-                interrupted_syscalls[pid] = body
+                interrupted_syscalls[pid] = (body, self.cur_time)
                 continue
             match = self._resumed_re.match(line)
             if match:
@@ -326,8 +473,9 @@ class DepsTracer(object):
                 if pid not in interrupted_syscalls:
                     self._on_parsing_error("unexpected resumed syscall")
                     continue
-                line = interrupted_syscalls[pid] + body
-                del interrupted_syscalls[pid]
+                # The syscall started at the time of its unfinished line
+                beginning, self.cur_start = interrupted_syscalls.pop(pid)
+                line = beginning + body
 
             # Parse syscall line
             fop = self._file_re.match(line)
@@ -336,39 +484,235 @@ class DepsTracer(object):
                 continue
 
             pid, op, ret = fop.group('pid'), fop.group('op'), fop.group('ret')
+            duration = fop.group('duration')
+            self.cur_duration = float(duration) if duration else 0.0
             args = [arg.strip().strip('"') for arg in fop.group('arg').split(',')]
-            V2("pid=%s, op='%s', args=%s, ret=%s" % (pid, op, args, ret))
+            if _verbose >= 2:
+                V2("pid=%s, op='%s', args=%s, ret=%s", pid, op, args, ret)
             yield (pid, op, ret, args) # rework!!
         if interrupted_syscalls:
             warn("excessive interrupted syscall(s) at the end of trace:")
-            for k, v in interrupted_syscalls.items():
-                V0("........ %s: %r" % (k, v))
+            for k, (v, _) in interrupted_syscalls.items():
+                V0("........ %s: %r", k, v)
             if self.strict:
                 fatal("terminating due to a parsing error in strict mode")
             V0("(probably strace bugs, consider upgrading 'strace')")
             V0("(tracer output may be incomplete)")
 
 
-def process_results(options, rules, unmatched_lines):
+class TraceWriter(object):
+    """
+    Writes traced rules in the compact 'depstrace' format: one JSON object per line.
+
+    The first line is a header, every other line is a rule record:
+        {"OUT": [ids], "IN": [ids], "LINE": n, "PID": "pid|pid", "PATHS": [new paths]}
+    'TIME' is the rule wall time in seconds, if the trace had timestamps.
+    Paths are interned into a table shared by the whole file; 'PATHS' (if present)
+    lists the paths first seen by the record, which get the next free ids in order,
+    before 'OUT'/'IN' ids are resolved. Records are written as rules are processed.
+    """
+    def __init__(self, fh):
+        self.fh = fh
+        self.path_ids = dict() # path -> id
+        self._write({'FORMAT': _TRACE_FORMAT, 'VERSION': _TRACE_FORMAT_VERSION})
+
+    def _write(self, record):
+        self.fh.write(json.dumps(record, separators=(',', ':')))
+        self.fh.write('\n')
+
+    def _intern(self, paths, new_paths):
+        ids = []
+        for path in paths:
+            path_id = self.path_ids.get(path)
+            if path_id is None:
+                path_id = self.path_ids[path] = len(self.path_ids)
+                new_paths.append(path)
+            ids.append(path_id)
+        return ids
+
+    def write_rule(self, outputs, deps, lineno, pids, wall_time=None):
+        new_paths = []
+        record = {'OUT': self._intern(outputs, new_paths),
+                  'IN': self._intern(deps, new_paths),
+                  'LINE': lineno,
+                  'PID': "|".join(pids)}
+        if wall_time:
+            record['TIME'] = round(wall_time, 6)
+        if new_paths:
+            record['PATHS'] = new_paths
+        self._write(record)
+
+def process_results(options, rules, unmatched_lines, paths):
     # Display unmatched lines..
     if unmatched_lines:
         warn("Summary of all unmatched lines:")
         V0("........ (probably strace bugs, consider upgrading 'strace')")
         for l in unmatched_lines:
-            V0("........ unmatched: %r" % l)
+            V0("........ unmatched: %r", l)
 
     # Log results
-    info("Detected %d build rules in total, writing log: %s" % (len(rules), options.outfile))
+    info("Detected %d build rules in total, writing log: %s", len(rules), options.outfile)
     with open(options.outfile, "w") as f:
+        writer = TraceWriter(f)
         for rule in rules:
-            deps = sorted(rule.get_deps_filtered())
-            outputs = sorted(rule.get_outputs_filtered())
-            f.write("{'OUT': %r, 'IN': %r, 'LINE': %d, 'PID': %r}\n" % (
-                outputs, deps, rule.lineno, "|".join(rule.pids)))
+            deps = sorted(paths[i] for i in rule.get_deps_filtered())
+            outputs = sorted(paths[i] for i in rule.get_outputs_filtered())
+            writer.write_rule(outputs, deps, rule.lineno, rule.pids, rule.get_wall_time())
     info("Done")
 
+def _hash_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        # Temporary or deleted output
+        return None
+
+def write_output_hashes(outfile, rules, paths, build_dir):
+    """
+    Snapshot content hashes of the outputs written by each traced rule, as:
+        {"FORMAT": "depstrace-hashes", "VERSION": 1, "RULES": [{"OUT": [paths], "HASH": [hashes]}]}
+    Snapshots of consecutive builds are compared by 'deps.py --restat' to
+    find rules rewriting their outputs byte-identical.
+    """
+    info("Hashing outputs of %d build rules, writing: %s", len(rules), outfile)
+    records = []
+    for rule in rules:
+        outputs = sorted(paths[i] for i in rule.get_outputs_filtered())
+        if outputs:
+            records.append({'OUT': outputs,
+                            'HASH': [_hash_file(os.path.join(build_dir, o)) for o in outputs]})
+    with open(outfile, "w") as f:
+        json.dump({'FORMAT': _HASHES_FORMAT, 'VERSION': _HASHES_FORMAT_VERSION, 'RULES': records}, f)
+
+def print_timing_report(rules, paths, top):
+    timed_rules = [r for r in rules if r.get_wall_time()]
+    if not timed_rules:
+        warn("No timestamps found in the trace, record it with 'strace -ttt -T' (or '-tt'/'-r')")
+        return
+
+    info("Slowest %d of %d timed rules (wall time, time spent in syscalls):",
+         min(top, len(timed_rules)), len(timed_rules))
+    for rule in sorted(timed_rules, key=TracedRule.get_wall_time, reverse=True)[:top]:
+        outputs = sorted(paths[i] for i in rule.get_outputs_filtered())
+        V0("%10.3fs %10.3fs  %s", rule.get_wall_time(), rule.get_syscall_time(),
+           " ".join(outputs) or "<strace log line %d>" % rule.lineno)
+
+    stages = defaultdict(list) # tool -> processes
+    for rule in timed_rules:
+        for process in rule.processes:
+            if process.start is not None:
+                stages[process.tool].append(process)
+    def total_time(item):
+        return sum(p.get_wall_time() for p in item[1])
+
+    info("Slowest %d tool stages (total, max and syscalls time, runs):", min(top, len(stages)))
+    for tool, processes in sorted(stages.items(), key=total_time, reverse=True)[:top]:
+        V0("%10.3fs %10.3fs %10.3fs %6d  %s",
+           total_time((tool, processes)),
+           max(p.get_wall_time() for p in processes),
+           sum(p.syscall_time for p in processes),
+           len(processes), tool)
+
+def _common_path_suffix(path, other):
+    parts, other_parts = path.split(os.path.sep), other.split(os.path.sep)
+    n = 0
+    while n < min(len(parts), len(other_parts)) and parts[-1 - n] == other_parts[-1 - n]:
+        n += 1
+    return os.path.sep.join(parts[len(parts) - n:])
+
+def _split_include_path(path, name):
+    return path[:-len(name)].rstrip(os.path.sep) or os.curdir
+
+def analyze_header_misses(rule, paths):
+    """
+    Reconstruct header (and library) searches of a rule from its failed and
+    successful opens. A failed open is matched to the opened file sharing the
+    longest path suffix with it: the shared suffix is the included name, the
+    rest of the failed path is the search directory which missed it.
+
+    Return (search dirs in the order probed, {dir: misses}, {dir: hits},
+    suggested dirs order, misses expected with the suggested order), where
+    the suggested order is by hits, most first.
+    """
+    found_by_name = defaultdict(list) # basename -> opened paths
+    for path_id in rule.lookups:
+        found_by_name[os.path.basename(paths[path_id])].append(paths[path_id])
+
+    search_dirs = dict() # dir -> None, ordered by first probe
+    hit_dirs = dict()
+    misses = defaultdict(int)
+    hits = defaultdict(int)
+    for path_id in rule.lookup_misses:
+        path = paths[path_id]
+        name = os.path.basename(path)
+        hit = None
+        for found in found_by_name.get(name, ()):
+            suffix = _common_path_suffix(path, found)
+            if len(suffix) >= len(name):
+                name, hit = suffix, found
+        search_dir = _split_include_path(path, name)
+        search_dirs.setdefault(search_dir)
+        misses[search_dir] += 1
+        if hit:
+            hit_dirs.setdefault(_split_include_path(hit, name))
+    # A dir which never missed stops every search reaching it, so it is probed
+    # after all the dirs which did
+    for hit_dir in hit_dirs:
+        search_dirs.setdefault(hit_dir)
+
+    # Attribute every opened file to the first probed dir it is found in
+    lookup_dirs = list()
+    for path_id in rule.lookups:
+        path = paths[path_id]
+        for search_dir in search_dirs:
+            if path.startswith(search_dir + os.path.sep) or (os.path.dirname(path) or os.curdir) == search_dir:
+                hits[search_dir] += 1
+                lookup_dirs.append(search_dir)
+                break
+
+    # Every dir probed ahead of the one providing the file is a miss; files never
+    # found keep missing in all dirs whatever the order.
+    suggested = sorted(search_dirs, key=lambda d: hits[d], reverse=True)
+    position = dict((d, i) for i, d in enumerate(suggested))
+    unresolved = sum(misses.values()) - sum(list(search_dirs).index(d) for d in lookup_dirs)
+    expected_misses = max(unresolved, 0) + sum(position[d] for d in lookup_dirs)
+    return list(search_dirs), misses, hits, suggested, expected_misses
+
+def print_header_misses_report(rules, paths, top):
+    analyzed = []
+    dir_misses = defaultdict(int)
+    for rule in rules:
+        if not rule.lookup_misses:
+            continue
+        search_dirs, misses, hits, suggested, expected_misses = analyze_header_misses(rule, paths)
+        analyzed.append((len(rule.lookup_misses), rule, search_dirs, misses, hits, suggested, expected_misses))
+        for search_dir, n in misses.items():
+            dir_misses[search_dir] += n
+    if not analyzed:
+        info("No failed opens found in the trace")
+        return
+
+    info("Failed opens (header search misses) in total: %d in %d rules",
+         sum(a[0] for a in analyzed), len(analyzed))
+    info("Search dirs causing most misses:")
+    for search_dir, n in sorted(dir_misses.items(), key=lambda x: x[1], reverse=True)[:top]:
+        V0("%8d  %s", n, search_dir)
+
+    info("Rules with most misses (misses/hits per dir in the order probed):")
+    warn("Reordering search dirs is only safe if no header is shadowed by another one with the same name")
+    for total, rule, search_dirs, misses, hits, suggested, expected_misses in \
+            sorted(analyzed, key=lambda a: a[0], reverse=True)[:top]:
+        outputs = sorted(paths[i] for i in rule.get_outputs_filtered())
+        V0("%s: %d misses", " ".join(outputs) or "<strace log line %d>" % rule.lineno, total)
+        for search_dir in search_dirs:
+            V0("%12d/%-6d %s", misses[search_dir], hits[search_dir], search_dir)
+        if expected_misses < total:
+            V0("  suggested order (%d misses expected): %s",
+               expected_misses, " ".join("-I%s" % d for d in suggested))
+
 def tracecmd(options, args):
-    tracer = DepsTracer(strict=options.strict)
+    tracer = DepsTracer(strict=options.strict, track_misses=bool(options.header_misses))
 
     # Build & trace
     #status, rules = tracer.trace(cmd=args)
@@ -378,16 +722,28 @@ def tracecmd(options, args):
         print("**ERROR**: cwd:", os.getcwd(), file=sys.stderr)
         return status
 
-    process_results(options, rules, tracer.unmatched_lines)
+    process_results(options, rules, tracer.unmatched_lines, tracer.paths)
+    if options.timing:
+        print_timing_report(rules, tracer.paths, options.timing)
+    if options.header_misses:
+        print_header_misses_report(rules, tracer.paths, options.header_misses)
+    if options.hash_outputs:
+        write_output_hashes(options.hash_outputs, rules, tracer.paths, tracer.build_dir)
     return 0
 
 def parse_tracefile(options):
-    tracer = DepsTracer(strict=options.strict)
+    tracer = DepsTracer(strict=options.strict, track_misses=bool(options.header_misses))
 
     # Process pre-recorded tracefile
     with open(options.from_tracefile, "r") as trace_file:
         rules = tracer.parse_trace(trace_file)
-        process_results(options, rules, tracer.unmatched_lines)
+        process_results(options, rules, tracer.unmatched_lines, tracer.paths)
+        if options.timing:
+            print_timing_report(rules, tracer.paths, options.timing)
+        if options.header_misses:
+            print_header_misses_report(rules, tracer.paths, options.header_misses)
+        if options.hash_outputs:
+            write_output_hashes(options.hash_outputs, rules, tracer.paths, tracer.build_dir)
     return 0
 
 if __name__ == '__main__':
@@ -402,6 +758,15 @@ if __name__ == '__main__':
     parser.add_option('-v', '--verbose', action='count', default=0)
     parser.add_option('--strict', action='store_true', default=False,
                       help="Don't tolerate parsing errors when tracing")
+    parser.add_option('--timing', type='int', default=0, metavar='N',
+                      help="report N slowest rules and tool stages"
+                      " (needs a trace recorded with 'strace -ttt -T')")
+    parser.add_option('--header-misses', type='int', default=0, metavar='N',
+                      help="report header search misses (failed opens) per search dir"
+                      " for N rules with most misses, and suggest a better dir order")
+    parser.add_option('--hash-outputs', metavar='FILE',
+                      help="snapshot content hashes of the traced outputs to FILE,"
+                      " run right after the traced build (see 'deps.py --restat')")
     (options, args) = parser.parse_args()
 
     # Global verbosity settings
@@ -410,7 +775,7 @@ if __name__ == '__main__':
     if options.from_tracefile:
         # Process an existing strace output file instead of
         #  actually running the command under strace
-        info("""Processing tracefile: %r""" % options.from_tracefile)
+        info("""Processing tracefile: %r""", options.from_tracefile)
         parse_tracefile(options)
         sys.exit(0)
 
@@ -419,6 +784,6 @@ if __name__ == '__main__':
         print("ERROR: invalid command line", file=sys.stderr)
         print("Either '-r<file>' or a 'command' should be specified.", file=sys.stderr)
         sys.exit(-1)
-    info("""Tracing: %r""" % args)
+    info("""Tracing: %r""", args)
     ret = tracecmd(options, args)
     sys.exit(ret)
@@ -0,0 +1,198 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import deps
+
+def _deps_log(version, paths, records):
+    """A ninja deps log: 'paths' records, then (output id, mtime, input ids) records"""
+    data = b'# ninjadeps\n' + struct.pack('<i', version)
+    for i, path in enumerate(paths):
+        encoded = path.encode()
+        encoded += b'\0' * (-len(encoded) % 4)
+        data += struct.pack('<I', len(encoded) + 4) + encoded + struct.pack('<I', ~i & 0xFFFFFFFF)
+    mtime_format = '<q' if version >= 4 else '<I'
+    for out_id, mtime, input_ids in records:
+        body = struct.pack('<i', out_id) + struct.pack(mtime_format, mtime)
+        body += struct.pack('<%di' % len(input_ids), *input_ids)
+        data += struct.pack('<I', len(body) | 0x80000000) + body
+    return data
+
+class NinjaDepsLogParserTest(unittest.TestCase):
+    def _parse(self, data):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, '.ninja_deps')
+            with open(path, 'wb') as f:
+                f.write(data)
+            return deps.NinjaDepsLogParser(path)
+
+    def test_v3(self):
+        log = self._parse(_deps_log(3, ['a.o', 'src/a.c', 'inc/a.h'], [(0, 1234, [1, 2])]))
+        self.assertEqual(log.paths, ['a.o', 'src/a.c', 'inc/a.h'])
+        self.assertEqual(log.get_deps('a.o'), ['src/a.c', 'inc/a.h'])
+        self.assertEqual(log.get_mtime('a.o'), 1234 * 1000000000)
+
+    def test_v4(self):
+        log = self._parse(_deps_log(4, ['ab.o', 'src/ab.c'], [(0, 1234567890123, [1])]))
+        self.assertEqual(log.paths, ['ab.o', 'src/ab.c'])
+        self.assertEqual(log.get_deps('ab.o'), ['src/ab.c'])
+        self.assertEqual(log.get_mtime('ab.o'), 1234567890123)
+
+    def test_truncated(self):
+        data = _deps_log(4, ['a.o', 'src/a.c'], [(0, 1, [1])])
+        log = self._parse(data[:-2])
+        self.assertEqual(log.paths, ['a.o', 'src/a.c'])
+        self.assertIsNone(log.get_deps('a.o'))
+
+class HashCommandTest(unittest.TestCase):
+    def test_murmurhash64a(self):
+        # Build logs up to v6
+        self.assertEqual(deps.hash_command('', 6), 0x87c2bc0beaf1d91d)
+        self.assertEqual(deps.hash_command('12345678', 6), 0x2d1ccbcd8d67231f)
+        self.assertEqual(deps.hash_command('cp s.in stamp', 6), 0x171b163931ad0580)
+        self.assertEqual(deps.hash_command('gcc -c a.c -o a.o', 5), 0xcfc141ee3d0f1211)
+
+    def test_rapidhash(self):
+        # As recorded by ninja 1.13 in v7 build logs
+        self.assertEqual(deps.hash_command('true'), 0x090a52a5dca2ed61)
+        self.assertEqual(deps.hash_command('cp s.in stamp'), 0xa96cb9b59fb1d884)
+        self.assertEqual(deps.hash_command('touch c # ' + 'x' * 30), 0x83e90ef91de8960a)
+        self.assertEqual(deps.hash_command('touch d # ' + 'y' * 80), 0xec94ff2c1f39d441)
+        self.assertEqual(deps.hash_command('touch e # ' + 'z' * 200), 0x407d11c6ef93899a)
+
+class NinjaLogParserTest(unittest.TestCase):
+    def _parse(self, text):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, '.ninja_log')
+            with open(path, 'w') as f:
+                f.write(text)
+            return deps.NinjaLogParser(path)
+
+    def test_v4(self):
+        log = self._parse('# ninja log v4\n0\t250\t12\tout\tcp s.in out\n')
+        self.assertEqual(log.durations, {'out': 0.25})
+        self.assertEqual(log.entries, {'out': (12 * 1000000000, deps.hash_command('cp s.in out', 4))})
+
+    def test_v7(self):
+        log = self._parse('# ninja log v7\n0\t5\t12\tout\ta96cb9b59fb1d884\n0\t1\n')
+        self.assertEqual(log.entries, {'out': (12, 0xa96cb9b59fb1d884)})
+
+class NinjaManifestParserTest(unittest.TestCase):
+    def test_lazy_depfiles(self):
+        manifest = ('rule cc\n  command = cc $in -o $out\n  depfile = $out.d\n'
+                    'build a.o: cc a.c\n'
+                    'build b.o: cc b.c\n'
+                    'build app: cc a.o || gen\n'
+                    'build gen: phony\n')
+        with tempfile.TemporaryDirectory() as d:
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                for out, dep in (('a.o', 'a.h'), ('b.o', 'b.h')):
+                    with open(out + '.d', 'w') as f:
+                        f.write('%s: %s\n' % (out, dep))
+                parser = deps.NinjaManifestParser(io.StringIO(manifest), lazy_depfiles=True)
+                self.assertEqual(parser.load_targets_depfiles(['app']), 3)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(parser.target2edge['a.o'].depfile_deps, ['a.h'])
+        self.assertEqual(parser.target2edge['b.o'].depfile_deps, [])
+        self.assertNotIn(parser.target2edge['b.o'], parser.loaded_depfiles)
+
+class DirtyPredictorTest(unittest.TestCase):
+    rules = ('rule cp\n  command = cp $in $out\n'
+             'rule gen\n  command = gen $in $out\n  restat = 1\n')
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def _files(self, *paths):
+        """Creates 'paths', each newer than the previous ones"""
+        for i, path in enumerate(paths):
+            with open(path, 'w'):
+                pass
+            os.utime(path, ns=((i + 1) * 1000000000,) * 2)
+
+    def _log(self, **commands):
+        """Writes a build log of the outputs built by 'commands'"""
+        with open('.ninja_log', 'w') as f:
+            f.write('# ninja log v7\n')
+            for out, command in commands.items():
+                mtime = os.stat(out).st_mtime_ns if os.path.exists(out) else 0
+                f.write('0\t1\t%d\t%s\t%x\n' % (mtime, out, deps.hash_command(command)))
+
+    def _predict(self, manifest, targets=()):
+        parser = deps.NinjaManifestParser(io.StringIO(self.rules + manifest))
+        edges = deps.EdgeTable(parser.iterate_target_rules(), deps.NodeTable())
+        predictor = deps.DirtyPredictor(parser, edges, deps.load_ninja_log(parser))
+        dirty, maybe = predictor.predict(targets, deps.StatSnapshot(edges.nodes.paths))
+        outputs = lambda indices: sorted(edges.nodes.paths[edges.edges[i].provides_ids[0]] for i in indices)
+        return outputs(dirty), outputs(maybe)
+
+    def test_up_to_date(self):
+        self._files('s.in', 'out')
+        self._log(out='cp s.in out')
+        self.assertEqual(self._predict('build out: cp s.in\n'), ([], []))
+
+    def test_missing_output(self):
+        self._files('s.in')
+        self._log(out='cp s.in out')
+        self.assertEqual(self._predict('build out: cp s.in\n'), (['out'], []))
+
+    def test_older_output(self):
+        self._files('out', 's.in')
+        self._log(out='cp s.in out')
+        self.assertEqual(self._predict('build out: cp s.in\n'), (['out'], []))
+
+    def test_changed_command(self):
+        self._files('s.in', 'out')
+        self._log(out='cp -p s.in out')
+        self.assertEqual(self._predict('build out: cp s.in\n'), (['out'], []))
+
+    def test_no_build_log(self):
+        self._files('s.in', 'out')
+        self.assertEqual(self._predict('build out: cp s.in\n'), (['out'], []))
+
+    def test_restat(self):
+        self._files('gen.h', 'a.o', 'gen.in')
+        self._log(**{'gen.h': 'gen gen.in gen.h', 'a.o': 'cp gen.h a.o'})
+        self.assertEqual(self._predict('build gen.h: gen gen.in\nbuild a.o: cp gen.h\n'), (['gen.h'], ['a.o']))
+
+    def test_order_only(self):
+        self._files('a.c', 'gen.h', 'a.o', 'gen.in')
+        self._log(**{'gen.h': 'gen gen.in gen.h', 'a.o': 'cp a.c a.o'})
+        manifest = 'build gen.h: gen gen.in\nbuild a.o: cp a.c || gen.h\n'
+        self.assertEqual(self._predict(manifest, ['a.o']), (['gen.h'], []))
+
+    def test_phony_without_inputs(self):
+        self._files('s.in', 'stamp')
+        self._log(stamp='cp s.in stamp')
+        manifest = 'build always: phony\nbuild stamp: cp s.in | always\n'
+        self.assertEqual(self._predict(manifest), (['stamp'], []))
+        # Not dirty once its output exists
+        self._files('always', 's.in', 'stamp')
+        self._log(stamp='cp s.in stamp')
+        self.assertEqual(self._predict(manifest), ([], []))
+
+class GraphTest(unittest.TestCase):
+    def test_edge_products_num_of_unwanted_output(self):
+        manifest = ('rule r\n  command = touch $out\n'
+                    'build side.txt gen.h: r gen.in\n'
+                    'build a.o: r a.c | gen.h\n'
+                    'build app: r a.o\n')
+        parser = deps.NinjaManifestParser(io.StringIO(manifest))
+        edges = deps.EdgeTable(parser.iterate_target_rules(), deps.NodeTable())
+        graph = deps.create_graph('build.ninja', edges, ['app'], clean_build_graph=True)
+        gen = edges.id2edge[edges.nodes.get_id('gen.h')]
+        self.assertEqual(graph.get_edge_products_num(gen), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,323 @@
 import subprocess
+import copy
+import hashlib
+import heapq
+import json
+import mmap
 import os
+import pickle
 import re
+import sqlite3
+import sys
+import time
+import zlib
 import graphviz
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from collections import Counter
+from collections import Counter, defaultdict
+from collections.abc import Mapping
 import pandas as pd
 
+SNAPSHOT_VERSION = 1
+MAPPED_VERSION = 1
+SHARD_KEYS = ("hash", "directory", "rule")
+SOURCE_SUFFIXES = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm', '.s', '.S', '.asm')
+INCLUDE_RE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+INCLUDES_CACHE = ".ninja_booster_includes.cache"
+INCLUDE_DIR_RE = re.compile(r"\s-I\s?([\w\/\.]+)")
+
+'''
+    Existence, size and mtime of files, served from memory
+    Each directory is listed once by os.scandir(): the roots (build dir, source roots)
+    are walked upfront, other directories (e.g. system include dirs) on first query.
+    The stat() of a file is done on its first size/mtime query only.
+    refresh() drops everything, to call after the tree changed (e.g. after a build)
+'''
+class StatCache:
+    SKIPPED_DIRS = ('.git', '.hg', '.svn')
+
+    def __init__(self, roots:list=()) -> None:
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.refresh()
+
+    def refresh(self):
+        self._entries = dict() # dir path -> {name : os.DirEntry}
+        for root in self.roots:
+            self._walk(root)
+
+    def _list_dir(self, dir_path:str) -> dict:
+        entries = self._entries.get(dir_path)
+        if entries is None:
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = {entry.name : entry for entry in it}
+            except OSError:
+                entries = dict()
+            self._entries[dir_path] = entries
+        return entries
+
+    def _walk(self, root:str):
+        stack = [root]
+        while stack:
+            for entry in self._list_dir(stack.pop()).values():
+                if entry.name not in self.SKIPPED_DIRS and entry.is_dir(follow_symlinks=False) \
+                        and entry.path not in self._entries:
+                    stack.append(entry.path)
+
+    def _get_entry(self, path:str):
+        path = os.path.abspath(path)
+        return self._list_dir(os.path.dirname(path)).get(os.path.basename(path))
+
+    def _stat(self, path:str):
+        entry = self._get_entry(path)
+        if entry is None or not entry.is_file():
+            return None
+        try:
+            return entry.stat()
+        except OSError:
+            return None
+
+    def isfile(self, path:str) -> bool:
+        entry = self._get_entry(path)
+        return entry is not None and entry.is_file()
+
+    def get_size(self, path:str):
+        st = self._stat(path)
+        return st.st_size if st else None
+
+    def get_mtime_ns(self, path:str):
+        st = self._stat(path)
+        return st.st_mtime_ns if st else None
+
+'''
+    Index of the shard of a target among 'count' shards, by a stable hash of either:
+    its path ("hash"), its folder ("directory") or its rule ("rule")
+'''
+def shard_of(target:str, rule:str, count:int, by:str="hash") -> int:
+    if by not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key: {by}, expecting one of {SHARD_KEYS}")
+    key = target if by == "hash" else os.path.dirname(target) if by == "directory" else rule
+    return zlib.crc32(key.encode()) % count
+
+'''
+    Dependencies of targets in memory-mapped files (see write()), read lazily
+    A read-only mapping of target -> dependencies like a dict of lists, processes opening
+    the same directory share its pages. Files:
+    - paths.dat, paths.off: the sorted path table (of all targets, dependencies and their folders)
+      and the offsets of the paths in it
+    - deps.dat, deps.off: the dependencies of each path as sorted path ids, and their offsets by path id
+    - targets.dat: the sorted target ids
+    - folders.dat: the path id of the folder of each path (NO_FOLDER for folders), in_tree.dat: 1 per in-tree path
+    view() gives the same mapping for some targets and/or for in-tree dependencies only.
+'''
+class MappedDependencies(Mapping):
+    NO_FOLDER = 0xFFFFFFFF
+    class _PathKeys:
+        ''' Encoded paths by id, to bisect the path table '''
+        def __init__(self, mapped) -> None:
+            self.mapped = mapped
+
+        def __len__(self):
+            return len(self.mapped._paths_off) - 1
+
+        def __getitem__(self, i):
+            return self.mapped._paths[self.mapped._paths_off[i]:self.mapped._paths_off[i + 1]]
+
+    def __init__(self, directory:str) -> None:
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != MAPPED_VERSION:
+            raise ValueError(f"{directory}: unsupported version {meta.get('version')}")
+        self._paths = self._map("paths.dat")
+        self._paths_off = self._map("paths.off", "Q")
+        self._deps = self._map("deps.dat", "I")
+        self._deps_off = self._map("deps.off", "Q")
+        self._target_ids = self._map("targets.dat", "I")
+        self._folders = self._map("folders.dat", "I")
+        self._in_tree = self._map("in_tree.dat", "B")
+        self._path_keys = self._PathKeys(self)
+        self.in_tree_only = False
+
+    def _map(self, name:str, typecode:str=None):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"").cast(typecode) if typecode else b""
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm).cast(typecode) if typecode else mm
+
+    '''
+        Writes the (target, dependencies) pairs of 'target_deps' into 'directory'
+        Only the path table is held in memory, the dependencies are streamed into a temporary
+        file, then written in path id order.
+    '''
+    @staticmethod
+    def _write_array(directory:str, name:str, values:array):
+        with open(os.path.join(directory, name), "wb") as f:
+            values.tofile(f)
+
+    @staticmethod
+    def write(directory:str, target_deps, in_tree) -> str:
+        os.makedirs(directory, exist_ok=True)
+        temp_ids = dict() # path -> id in order of appearance
+        def intern(path):
+            temp_id = temp_ids.get(path)
+            if temp_id is None:
+                temp_id = temp_ids[path] = len(temp_ids)
+            return temp_id
+        targets = array("I")
+        spans = array("Q")
+        temp_path = os.path.join(directory, "deps.tmp")
+        with open(temp_path, "wb") as temp:
+            written = 0
+            for target, deps in target_deps:
+                targets.append(intern(target))
+                spans.append(written)
+                ids = array("I", (intern(dep) for dep in deps))
+                ids.tofile(temp)
+                written += len(ids)
+            spans.append(written)
+        for path in list(temp_ids):
+            intern(os.path.dirname(path))
+        final_ids = array("I", bytes(4 * len(temp_ids)))
+
+        paths = sorted(temp_ids, key=str.encode)
+        for final_id, path in enumerate(paths):
+            final_ids[temp_ids[path]] = final_id
+        with open(os.path.join(directory, "paths.dat"), "wb") as f:
+            offsets = array("Q", [0])
+            for path in paths:
+                encoded = path.encode()
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        MappedDependencies._write_array(directory, "paths.off", offsets)
+        folder_ids = (temp_ids.get(os.path.dirname(path)) for path in paths)
+        MappedDependencies._write_array(directory, "folders.dat", array("I", (
+            MappedDependencies.NO_FOLDER if f is None else final_ids[f] for f in folder_ids)))
+        def is_in_tree(path):
+            try:
+                return bool(in_tree(path))
+            except ValueError: # relative paths
+                return False
+        MappedDependencies._write_array(directory, "in_tree.dat", array("B", (is_in_tree(path) for path in paths)))
+        target_index = {final_ids[t]: k for k, t in enumerate(targets)}
+        MappedDependencies._write_array(directory, "targets.dat", array("I", sorted(target_index)))
+
+        with open(temp_path, "rb") as temp, open(os.path.join(directory, "deps.dat"), "wb") as f:
+            mm = mmap.mmap(temp.fileno(), 0, access=mmap.ACCESS_READ) if written else None
+            view = memoryview(mm if mm else b"")
+            temp_deps = view.cast("I")
+            offsets = array("Q", [0])
+            for final_id in range(len(paths)):
+                k = target_index.get(final_id)
+                if k is not None:
+                    ids = array("I", sorted(set(final_ids[d] for d in temp_deps[spans[k]:spans[k + 1]])))
+                    ids.tofile(f)
+                    offsets.append(offsets[-1] + len(ids))
+                else:
+                    offsets.append(offsets[-1])
+            temp_deps.release()
+            view.release()
+            if mm:
+                mm.close()
+        MappedDependencies._write_array(directory, "deps.off", offsets)
+        os.remove(temp_path)
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"version": MAPPED_VERSION, "paths": len(paths), "targets": len(targets)}, f)
+        return directory
+
+    def view(self, targets:list=None, in_tree_only:bool=False):
+        view = copy.copy(self)
+        if targets is not None:
+            view._target_ids = array("I", sorted(set(i for i in (self.get_id(t) for t in targets)
+                                                     if i is not None and self._is_target(i))))
+        view.in_tree_only = in_tree_only
+        return view
+
+    def get_id(self, path:str):
+        key = path.encode()
+        i = bisect_left(self._path_keys, key)
+        return i if i < len(self._path_keys) and self._path_keys[i] == key else None
+
+    def get_path(self, path_id:int) -> str:
+        return self._path_keys[path_id].decode()
+
+    def _is_target(self, path_id:int) -> bool:
+        i = bisect_left(self._target_ids, path_id)
+        return i < len(self._target_ids) and self._target_ids[i] == path_id
+
+    def get_dependency_ids(self, path_id:int):
+        ids = self._deps[self._deps_off[path_id]:self._deps_off[path_id + 1]]
+        return [d for d in ids if self._in_tree[d]] if self.in_tree_only else ids
+
+    def __getitem__(self, target:str) -> list:
+        path_id = self.get_id(target)
+        if path_id is None or not self._is_target(path_id):
+            raise KeyError(target)
+        return [self.get_path(d) for d in self.get_dependency_ids(path_id)]
+
+    def __iter__(self):
+        return (self.get_path(t) for t in self._target_ids)
+
+    def __len__(self):
+        return len(self._target_ids)
+
+    def items(self):
+        return ((self.get_path(t), [self.get_path(d) for d in self.get_dependency_ids(t)]) for t in self._target_ids)
+
+    def __contains__(self, target) -> bool:
+        path_id = self.get_id(target)
+        return path_id is not None and self._is_target(path_id)
+
+    def _get_in_tree_ids(self, target:str) -> list:
+        path_id = self.get_id(target)
+        if path_id is None:
+            return []
+        return [d for d in self._deps[self._deps_off[path_id]:self._deps_off[path_id + 1]] if self._in_tree[d]]
+
+    def get_in_tree(self, target:str) -> list:
+        return [self.get_path(d) for d in self._get_in_tree_ids(target)]
+
+    ''' Folders of the in-tree dependencies of a target '''
+    def get_folders(self, target:str) -> set:
+        return set(self.get_path(f) for f in set(self._folders[d] for d in self._get_in_tree_ids(target)))
+
+    ''' Number of targets depending on each path, like count() '''
+    def count(self):
+        counts = array("L", bytes(array("L").itemsize * len(self._path_keys)))
+        for t in self._target_ids:
+            for d in self.get_dependency_ids(t):
+                counts[d] += 1
+        dependency_counts = Counter({self.get_path(d): c for d, c in enumerate(counts) if c})
+        return dependency_counts, set(dependency_counts)
+
 class NinjaBooster:
     NINJA_VERSION = 1.11
 
-    def __init__(self, build_dir, root_folder=None, build_all=True) -> None:
-        self.root_folder = root_folder and os.path.isdir(root_folder) or os.getcwd()
+    '''
+        shard: (index, count, key) to analyse the targets of one shard only (see shard_of),
+        e.g. (0, 4, "hash") - the partial results of all shards are merged by merge_shards()
+        storage: directory to keep the dependencies of targets in, memory-mapped (see MappedDependencies)
+        instead of in a dict, for trees too large for the memory
+    '''
+    def __init__(self, build_dir, root_folder=None, build_all=True, shard:tuple=None, storage:str=None) -> None:
+        self.shard = shard
+        self.storage = storage
+        if shard is not None:
+            shard_of("", "", shard[1], shard[2])
+        self.root_folder = root_folder if root_folder and os.path.isdir(root_folder) else os.getcwd()
         self.build_dir = build_dir if os.path.isabs(build_dir) else os.path.normpath(f"{self.root_folder}/{build_dir}")
+        self._build_durations = None
+        self._commands = None
         self.rules = self._get_all_ninja_rules()
         self.targets_per_rule: dict = self._collect_targets_of_rules()
         if(build_all):
             # os.isfile() check on compile and link outputs can work only after a build
             # ninja collects deps from compiler
             self._call_ninja_build()
+        self.stat_cache = StatCache([self.build_dir, self.root_folder])
 
         self.file_dependencies_per_target: dict  = self._collect_file_dependencies_of_targets()
         self.target_inputs_per_file_target: dict  = self._collect_inputs_of_file_targets()
@@ -65,21 +365,30 @@ class NinjaBooster:
 
         return list(all_deps_set)
 
-    def _collect_file_dependencies_of_targets(self):
-        dependencies_of_target = dict()
-        for _, targets in self.targets_per_rule.items():
+    def _in_shard(self, rule:str, target:str) -> bool:
+        return self.shard is None or shard_of(target, rule, self.shard[1], self.shard[2]) == self.shard[0]
+
+    def _iterate_file_dependencies_of_targets(self):
+        for rule, targets in self.targets_per_rule.items():
             for target in targets:
+                if not self._in_shard(rule, target):
+                    continue
                 deps = self._get_target_dependencies(target)
                 if deps:
-                    dependencies_of_target.update({target : deps})
-        return dependencies_of_target
+                    yield target, deps
+
+    def _collect_file_dependencies_of_targets(self):
+        if self.storage:
+            MappedDependencies.write(self.storage, self._iterate_file_dependencies_of_targets(), self.in_tree)
+            return MappedDependencies(self.storage)
+        return dict(self._iterate_file_dependencies_of_targets())
 
     ''' Method recursively collects until all file inputs are collected '''
     def _collect_file_inputs(self, target:str):
         inputs = self._call_ninja_tool(f"inputs {target}")
         input_files = []
         for i in inputs:
-            if os.path.isfile(i):
+            if self.stat_cache.isfile(os.path.join(self.build_dir, i)):
                 input_files.append(i)
             else:
                 input_files.extend(self._collect_file_inputs(i))
@@ -104,14 +413,17 @@ class NinjaBooster:
     '''
     def _collect_inputs_of_file_targets(self):
         final_targets = dict()
-        compile_link_targets = (targets for rule, targets in self.targets_per_rule.items()
-                                if re.search(r'COMPILE|LINK', rule, re.IGNORECASE))
+        compile_link_targets = [(rule, target) for rule, targets in self.targets_per_rule.items()
+                                if re.search(r'COMPILE|LINK', rule, re.IGNORECASE) for target in targets]
         # keep built(existing) and in build directory targets only
-        file_targets = [target for targets in compile_link_targets
-                        for target in targets if os.path.isfile(os.path.join(self.build_dir,target))
-                        and not os.path.isabs(target)]
+        file_targets = set(target for _, target in compile_link_targets
+                           if self.stat_cache.isfile(os.path.join(self.build_dir,target))
+                           and not os.path.isabs(target))
         # filter those targets that depends on another compile or link_targets (intermediate targets)
-        for target in file_targets:
+        # inputs are checked against the file targets of all shards
+        for rule, target in compile_link_targets:
+            if target not in file_targets or not self._in_shard(rule, target):
+                continue
             immediate_inputs = [inp for inp in self._call_ninja_tool(f"inputs {target}")
                            if inp in file_targets]
             if immediate_inputs:
@@ -163,6 +475,8 @@ class NinjaBooster:
         Gen non-system and non-external dependencies
     '''
     def get_in_tree_target_dependencies(self, target:str) -> list:
+        if isinstance(self.file_dependencies_per_target, MappedDependencies):
+            return self.file_dependencies_per_target.get_in_tree(target)
         all_deps = self.get_target_dependencies(target)
         in_tree_deps =[dep for dep in all_deps if self.in_tree(dep)]
 
@@ -173,7 +487,7 @@ class NinjaBooster:
     def get_all_include_dirs(self, target:str) -> list:
         cmd = self._get_command(target)
         # TODO: expand @file if there is any
-        include_dirs = re.findall(r"\s-I\s?([\w\/\.]+)", cmd)
+        include_dirs = INCLUDE_DIR_RE.findall(cmd)
         return include_dirs
 
     '''
@@ -203,7 +517,82 @@ class NinjaBooster:
             in_tree_final_target_deps.update({k:in_tree_deps})
         return in_tree_final_target_deps
 
+    '''
+        Durations (seconds) of the targets built by the last build, from .ninja_log
+        A later line of a target overrides the earlier ones
+    '''
+    def get_build_durations(self) -> dict:
+        if self._build_durations is None:
+            self._build_durations = dict()
+            log_path = os.path.join(self.build_dir, ".ninja_log")
+            if os.path.isfile(log_path):
+                with open(log_path) as log:
+                    for line in log:
+                        fields = line.rstrip("\n").split("\t")
+                        if line.startswith("#") or len(fields) < 5:
+                            continue
+                        self._build_durations[os.path.normpath(fields[3])] = (int(fields[1]) - int(fields[0])) / 1000
+        return self._build_durations
+
+    '''
+        Commands of all edges, by their (first) output, from a single ninja call
+        Unlike _get_command(), the command of the edge itself, not of its whole chain
+    '''
+    def get_commands(self) -> dict:
+        if self._commands is None:
+            compdb = json.loads("\n".join(self._call_ninja_tool("compdb")))
+            self._commands = {entry["output"]: entry["command"] for entry in compdb if "output" in entry}
+        return self._commands
+
+    '''
+        Number of changes of the files (absolute paths) in the last 'since_days' days
+        Counted from git history if root folder is in a git work tree, otherwise
+        a file modified in that period counts as changed once
+    '''
+    def get_change_counts(self, files:list, since_days:int=180) -> dict:
+        changes = Counter()
+        try:
+            top = subprocess.check_output(["git", "-C", self.root_folder, "rev-parse", "--show-toplevel"],
+                                          universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+            log = subprocess.check_output(["git", "-C", top, "log", f"--since={since_days}.days",
+                                           "--name-only", "--pretty=format:"], universal_newlines=True)
+            changes.update(os.path.normpath(os.path.join(top, f)) for f in log.splitlines() if f)
+            return {f: changes[f] for f in files}
+        except (subprocess.CalledProcessError, OSError):
+            since = time.time() - since_days * 24 * 3600
+            since_ns = since * 1e9
+            return {f: int((self.stat_cache.get_mtime_ns(f) or 0) >= since_ns) for f in files}
+
+    '''
+        Include directives (as spelled) of the files (absolute paths), by a lightweight scan
+        Results are cached in the build dir, a file is scanned again only if its mtime changed
+    '''
+    def scan_includes(self, files:list) -> dict:
+        cache_path = os.path.join(self.build_dir, INCLUDES_CACHE)
+        cache = dict()
+        if os.path.isfile(cache_path):
+            with open(cache_path, "rb") as f:
+                cache = pickle.load(f)
+        includes = dict()
+        updated = False
+        for path in files:
+            mtime = self.stat_cache.get_mtime_ns(path)
+            if mtime is None:
+                continue
+            cached = cache.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path, errors="replace") as f:
+                    cached = cache[path] = (mtime, INCLUDE_RE.findall(f.read()))
+                updated = True
+            includes[path] = cached[1]
+        if updated:
+            with open(cache_path, "wb") as f:
+                pickle.dump(cache, f)
+        return includes
+
     def get_dependencies_folder(self, target_dependency_dict) -> dict:
+        if isinstance(target_dependency_dict, MappedDependencies):
+            return {k: target_dependency_dict.get_folders(k) for k in target_dependency_dict}
         folder_deps = dict()
         for k, all_deps in target_dependency_dict.items():
             folders =(os.path.dirname(dep) for dep in all_deps if self.in_tree(dep))
@@ -211,6 +600,8 @@ class NinjaBooster:
         return folder_deps
 
 def count(dictionary):
+    if isinstance(dictionary, MappedDependencies):
+        return dictionary.count()
     all_values = []
     for _, vals in dictionary.items():
         all_values.extend(vals)
@@ -230,6 +621,9 @@ def get_compiled_target_deps(ninja_build_info: NinjaBooster, in_tree_only:bool=T
     target_deps = dict()
     compile_rules = ninja_build_info.filter_rules(contains="_COMPILER")
     compile_targets = ninja_build_info.get_all_targets(compile_rules)
+    if isinstance(ninja_build_info.file_dependencies_per_target, MappedDependencies):
+        # Lazy, targets without dependencies are left out
+        return ninja_build_info.file_dependencies_per_target.view(compile_targets, in_tree_only)
     for compile_target in compile_targets:
         d = ninja_build_info.get_in_tree_target_dependencies(compile_target) if in_tree_only \
             else  ninja_build_info.get_target_dependencies(compile_target)
@@ -237,6 +631,673 @@ def get_compiled_target_deps(ninja_build_info: NinjaBooster, in_tree_only:bool=T
 
     return target_deps
 
+'''
+    Recommends precompiled headers per link unit (final targets and their object inputs)
+    A PCH gets the headers included by at least 'min_share' of the unit's objects which
+    did not change more than 'max_changes' times in the last 'since_days' days.
+    Savings estimate: each object's compile time (from .ninja_log) is split among its
+    source and headers by file size, the PCH headers' share is saved for every object
+    but the one compiling the PCH itself.
+    Returns (unit, pch headers, estimated seconds saved) tuples, best first
+'''
+def recommend_pch(ninja_build_info: NinjaBooster, min_share:float=0.5, since_days:int=180, max_changes:int=0) -> list:
+    # Headers are interned, each with a bitset of the objects including it
+    header_ids = dict()
+    headers = []
+    header_objects = []
+    object_ids = dict()
+    object_headers = []
+    object_sizes = []
+    file_sizes = dict()
+    def size_of(dep):
+        if dep not in file_sizes:
+            path = os.path.join(ninja_build_info.build_dir, dep)
+            file_sizes[dep] = ninja_build_info.stat_cache.get_size(path) or 0
+        return file_sizes[dep]
+
+    for obj, deps in ninja_build_info.file_dependencies_per_target.items():
+        o = object_ids[obj] = len(object_headers)
+        ids = []
+        for dep in deps:
+            if dep.endswith(SOURCE_SUFFIXES):
+                continue
+            h = header_ids.get(dep)
+            if h is None:
+                h = header_ids[dep] = len(headers)
+                headers.append(dep)
+                header_objects.append(0)
+            header_objects[h] |= 1 << o
+            ids.append(h)
+        object_headers.append(ids)
+        object_sizes.append(sum(size_of(dep) for dep in deps) or 1)
+
+    abs_headers = [os.path.normpath(os.path.join(ninja_build_info.build_dir, h)) for h in headers]
+    changes = ninja_build_info.get_change_counts(abs_headers, since_days)
+    stable = [changes[h] <= max_changes for h in abs_headers]
+    durations = ninja_build_info.get_build_durations()
+
+    recommendations = []
+    for unit, objects in ninja_build_info.target_inputs_per_file_target.items():
+        unit_objects = [(obj, object_ids[obj]) for obj in objects if obj in object_ids]
+        if len(unit_objects) < 2:
+            # Nothing to share
+            continue
+        mask = 0
+        for _, o in unit_objects:
+            mask |= 1 << o
+        candidates = set(h for _, o in unit_objects for h in object_headers[o])
+        pch = set(h for h in candidates
+                  if stable[h] and (header_objects[h] & mask).bit_count() >= min_share * len(unit_objects))
+        if not pch:
+            continue
+        saved = [durations.get(obj, 0) * sum(size_of(headers[h]) for h in object_headers[o] if h in pch) / object_sizes[o]
+                 for obj, o in unit_objects]
+        recommendations.append((unit, sorted(headers[h] for h in pch), sum(saved) - max(saved)))
+    return sorted(recommendations, key=lambda r: r[2], reverse=True)
+
+'''
+    MinHash signatures of the header sets of targets, by one permutation hashing:
+    a single hash per header, keeping its minimum in each of the 'num_bins' bins
+    the hashes fall into (None for empty bins)
+'''
+def minhash_signatures(target_deps:dict, num_bins:int=64) -> dict:
+    hashed = dict() # dep -> (bin, value), None for sources
+    signatures = dict()
+    for target, deps in target_deps.items():
+        signature = [None] * num_bins
+        for dep in deps:
+            try:
+                entry = hashed[dep]
+            except KeyError:
+                # Stable across runs, unlike hash() of str
+                h = int.from_bytes(hashlib.blake2b(dep.encode(), digest_size=8).digest(), "little")
+                entry = hashed[dep] = None if dep.endswith(SOURCE_SUFFIXES) else divmod(h, num_bins)[::-1]
+            if entry is None:
+                continue
+            b, value = entry
+            if signature[b] is None or value < signature[b]:
+                signature[b] = value
+        signatures[target] = signature
+    return signatures
+
+'''
+    Jaccard similarity estimate of two header sets by their signatures
+'''
+def minhash_similarity(signature, other) -> float:
+    bins = same = 0
+    for a, b in zip(signature, other):
+        if a is not None or b is not None:
+            bins += 1
+            same += a == b
+    return same / bins if bins else 0.0
+
+'''
+    Recommends unity (jumbo) batches of compile targets with similar header sets,
+    so that batching them saves the most header parses
+    Only targets of the same link unit are batched, up to 'max_batch_size' targets
+    and 'max_batch_time' seconds of compile time (from .ninja_log) per batch.
+    Candidates come from LSH buckets of the MinHash signatures: targets sharing a
+    band ('band_size' bins) of their signature, no pairwise comparison of all targets.
+    Returns (unit, batch targets, header parses saved, batch compile time) tuples, best first
+'''
+def recommend_unity_batches(ninja_build_info: NinjaBooster, target_deps:dict=None, max_batch_size:int=8,
+                            max_batch_time:float=120.0, min_similarity:float=0.5,
+                            num_bins:int=64, band_size:int=4) -> list:
+    if target_deps is None:
+        target_deps = get_compiled_target_deps(ninja_build_info, in_tree_only=False)
+    durations = ninja_build_info.get_build_durations()
+    unit_of = {obj: unit for unit, objects in ninja_build_info.target_inputs_per_file_target.items()
+               for obj in objects}
+    signatures = minhash_signatures(target_deps, num_bins)
+
+    buckets = defaultdict(list)
+    target_buckets = dict()
+    for target, signature in signatures.items():
+        keys = []
+        for start in range(0, num_bins, band_size):
+            band = tuple(signature[start:start + band_size])
+            if band.count(None) == len(band):
+                continue
+            key = (unit_of.get(target), start, band)
+            buckets[key].append(target)
+            keys.append(key)
+        target_buckets[target] = keys
+
+    batched = set()
+    bucket_starts = defaultdict(int) # bucket key -> targets before it are all batched
+    batches = []
+    for seed in sorted(signatures, key=lambda t: len(target_deps[t]), reverse=True):
+        if seed in batched:
+            continue
+        batched.add(seed)
+        candidates = set()
+        for key in target_buckets[seed]:
+            bucket = buckets[key]
+            start = bucket_starts[key]
+            while start < len(bucket) and bucket[start] in batched:
+                start += 1
+            bucket_starts[key] = start
+            # A few batches worth of candidates per bucket is enough
+            for target in bucket[start:start + 4 * max_batch_size]:
+                if target not in batched:
+                    candidates.add(target)
+        batch = [seed]
+        batch_time = durations.get(seed, 0)
+        scored = sorted(((minhash_similarity(signatures[seed], signatures[t]), t) for t in candidates), reverse=True)
+        for similarity, target in scored:
+            if similarity < min_similarity or len(batch) >= max_batch_size:
+                break
+            if batch_time + durations.get(target, 0) > max_batch_time:
+                continue
+            batch.append(target)
+            batched.add(target)
+            batch_time += durations.get(target, 0)
+        if len(batch) > 1:
+            # Sources are distinct, only shared headers make the difference
+            deps = [set(target_deps[t]) for t in batch]
+            saved = sum(len(d) for d in deps) - len(set().union(*deps))
+            batches.append((unit_of.get(seed), batch, saved, batch_time))
+    return sorted(batches, key=lambda b: b[2], reverse=True)
+
+'''
+    Ranks single include removals (or splits of the including header) by how much they
+    reduce the total rebuild cost: the compile time (from .ninja_log) of every target
+    times the headers it depends on, each header weighted by 1 + its changes in the last
+    'since_days' days. Candidates are the includes of the 'top_headers' headers with the
+    most expensive fan-out.
+    The include graph comes from scanning in-tree files, includes are resolved to the
+    files known from the deps data. Reachability is computed on bitsets of file ids;
+    closures within include cycles are approximate.
+    Returns (header, included file, rebuild cost saved, targets affected) tuples, best first
+'''
+def recommend_include_cuts(ninja_build_info: NinjaBooster, top_headers:int=20, since_days:int=180) -> list:
+    build_dir = ninja_build_info.build_dir
+    file_ids = dict()
+    files = []
+    def intern(path):
+        i = file_ids.get(path)
+        if i is None:
+            i = file_ids[path] = len(files)
+            files.append(path)
+        return i
+
+    target_deps = dict()
+    for target, deps in ninja_build_info.file_dependencies_per_target.items():
+        target_deps[target] = [intern(os.path.normpath(os.path.join(build_dir, dep))) for dep in deps]
+
+    # Include graph over the known files
+    by_name = defaultdict(list)
+    for path in files:
+        by_name[os.path.basename(path)].append(path)
+    includes = [[] for _ in files]
+    for path, spellings in ninja_build_info.scan_includes([f for f in files if ninja_build_info.in_tree(f)]).items():
+        for spelling in spellings:
+            suffix = os.sep + os.path.normpath(spelling)
+            candidates = [f for f in by_name.get(os.path.basename(spelling), ()) if f.endswith(suffix)]
+            if candidates:
+                # The closest one, e.g. from the same dir
+                resolved = max(candidates, key=lambda f: len(os.path.commonpath((f, path))))
+                includes[file_ids[path]].append(file_ids[resolved])
+
+    closures = [None] * len(files)
+    for root in range(len(files)):
+        if closures[root] is not None:
+            continue
+        closures[root] = 1 << root
+        stack = [(root, iter(includes[root]))]
+        while stack:
+            v, children = stack[-1]
+            for w in children:
+                if closures[w] is None:
+                    closures[w] = 1 << w
+                    stack.append((w, iter(includes[w])))
+                    break
+            else:
+                stack.pop()
+                closure = 1 << v
+                for w in includes[v]:
+                    closure |= closures[w]
+                closures[v] = closure
+
+    changes = ninja_build_info.get_change_counts(files, since_days)
+    weights = [1 + changes[f] for f in files]
+    durations = ninja_build_info.get_build_durations()
+
+    # Per target: its deps bitset, reach from its sources' includes, compile time
+    targets = []
+    header_targets = defaultdict(list)
+    header_costs = Counter()
+    for target, deps in target_deps.items():
+        roots = [w for v in deps if files[v].endswith(SOURCE_SUFFIXES) for w in includes[v]]
+        if not roots:
+            continue
+        deps_bits = 0
+        for v in deps:
+            deps_bits |= 1 << v
+        reach = 0
+        for r in roots:
+            reach |= closures[r]
+        t = len(targets)
+        targets.append((roots, deps_bits, reach, durations.get(target, 1.0)))
+        for v in deps:
+            header_targets[v].append(t)
+            header_costs[v] += targets[t][3]
+
+    def weighted_count(bits):
+        total = 0
+        while bits:
+            low = bits & -bits
+            total += weights[low.bit_length() - 1]
+            bits ^= low
+        return total
+
+    cuts = []
+    hot = [h for h, _ in header_costs.most_common() if includes[h]][:top_headers]
+    for h in hot:
+        # Files reaching 'h', children first: closures grow up the include graph
+        ancestors = sorted((v for v in range(len(files)) if v != h and closures[v] >> h & 1),
+                           key=lambda v: closures[v].bit_count())
+        for cut in set(includes[h]):
+            cut_closures = {h: 1 << h}
+            for w in includes[h]:
+                if w != cut:
+                    cut_closures[h] |= closures[w]
+            for v in ancestors:
+                closure = 1 << v
+                for w in includes[v]:
+                    closure |= cut_closures.get(w, closures[w])
+                cut_closures[v] = closure
+            saved = 0
+            affected = 0
+            for t in header_targets[h]:
+                roots, deps_bits, reach, duration = targets[t]
+                cut_reach = 0
+                for r in roots:
+                    cut_reach |= cut_closures.get(r, closures[r])
+                lost = reach & ~cut_reach & deps_bits
+                if lost:
+                    affected += 1
+                    saved += duration * weighted_count(lost)
+            if saved:
+                cuts.append((files[h], files[cut], saved, affected))
+    return sorted(cuts, key=lambda c: c[2], reverse=True)
+
+SQLITE_SCHEMA = """
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, folder TEXT NOT NULL, in_tree INTEGER NOT NULL);
+CREATE TABLE rules (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE targets (file_id INTEGER PRIMARY KEY REFERENCES files(id), rule_id INTEGER NOT NULL REFERENCES rules(id),
+                      command TEXT, duration REAL);
+CREATE TABLE deps (target_id INTEGER NOT NULL REFERENCES files(id), file_id INTEGER NOT NULL REFERENCES files(id),
+                   PRIMARY KEY (target_id, file_id)) WITHOUT ROWID;
+CREATE TABLE include_dirs (target_id INTEGER NOT NULL REFERENCES files(id), position INTEGER NOT NULL, dir TEXT NOT NULL,
+                           PRIMARY KEY (target_id, position)) WITHOUT ROWID;
+CREATE TABLE final_target_inputs (final_id INTEGER NOT NULL REFERENCES files(id), input_id INTEGER NOT NULL REFERENCES files(id),
+                                  PRIMARY KEY (final_id, input_id)) WITHOUT ROWID;
+"""
+# Created after the bulk inserts, it's faster than updating them row by row
+SQLITE_INDEXES = """
+CREATE INDEX files_folder ON files(folder);
+CREATE INDEX targets_rule ON targets(rule_id);
+CREATE INDEX deps_file ON deps(file_id, target_id);
+CREATE INDEX include_dirs_dir ON include_dirs(dir);
+CREATE INDEX final_target_inputs_input ON final_target_inputs(input_id, final_id);
+"""
+
+'''
+    Exports the model into a SQLite database (replaced if it exists), for ad-hoc queries
+    Files (targets, dependencies) are in 'files', with their path as ninja reports it and their
+    absolute folder; 'deps', 'include_dirs' and 'final_target_inputs' refer to them by id.
+    E.g. the final targets including boost/asio from the objects of folder X:
+      SELECT DISTINCT f.path FROM final_target_inputs i JOIN deps d ON d.target_id = i.input_id
+        JOIN files h ON h.id = d.file_id JOIN files o ON o.id = i.input_id JOIN files f ON f.id = i.final_id
+        WHERE h.path LIKE '%/boost/asio/%' AND o.folder LIKE '%/X/%'
+'''
+def export_sqlite(ninja_build_info: NinjaBooster, db_path:str="ninja_booster.db") -> str:
+    file_ids = dict()
+    files = []
+    def intern(path):
+        file_id = file_ids.get(path)
+        if file_id is None:
+            file_id = file_ids[path] = len(files)
+            abs_path = os.path.normpath(os.path.join(ninja_build_info.build_dir, path))
+            files.append((file_id, path, os.path.dirname(abs_path), ninja_build_info.in_tree(abs_path)))
+        return file_id
+
+    commands = ninja_build_info.get_commands()
+    durations = ninja_build_info.get_build_durations()
+    rules = []
+    targets = []
+    include_dirs = []
+    for rule_id, (rule, rule_targets) in enumerate(ninja_build_info.targets_per_rule.items()):
+        rules.append((rule_id, rule))
+        for target in rule_targets:
+            target_id = intern(target)
+            command = commands.get(target) or None
+            targets.append((target_id, rule_id, command, durations.get(os.path.normpath(target))))
+            if command:
+                include_dirs.extend((target_id, position, d) for position, d in enumerate(INCLUDE_DIR_RE.findall(command)))
+    deps = [(intern(target), intern(dep))
+            for target, target_deps in ninja_build_info.file_dependencies_per_target.items() for dep in target_deps]
+    final_target_inputs = [(intern(final_target), intern(i))
+                           for final_target, inputs in ninja_build_info.target_inputs_per_file_target.items() for i in inputs]
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    con = sqlite3.connect(db_path)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(SQLITE_SCHEMA)
+        with con:
+            con.executemany("INSERT INTO info VALUES (?, ?)", [("root_folder", ninja_build_info.root_folder),
+                                                               ("build_dir", ninja_build_info.build_dir),
+                                                               ("created", time.strftime("%Y-%m-%dT%H:%M:%S"))])
+            con.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", files)
+            con.executemany("INSERT INTO rules VALUES (?, ?)", rules)
+            # A target can be listed by more than one rule (e.g. phony aliases), the first one wins
+            con.executemany("INSERT OR IGNORE INTO targets VALUES (?, ?, ?, ?)", targets)
+            con.executemany("INSERT OR IGNORE INTO deps VALUES (?, ?)", deps)
+            con.executemany("INSERT INTO include_dirs VALUES (?, ?, ?)", include_dirs)
+            con.executemany("INSERT OR IGNORE INTO final_target_inputs VALUES (?, ?)", final_target_inputs)
+        con.executescript(SQLITE_INDEXES)
+        con.execute("ANALYZE")
+    finally:
+        con.close()
+    print(f"Exported {len(targets)} targets, {len(files)} files and {len(deps)} dependencies into {db_path}")
+    return db_path
+
+'''
+    Saves the partial results of the shard analysed by 'ninja_build_info': dependency counts,
+    folder dependencies and the reverse index (dependency -> sorted targets) of the in-tree
+    dependencies of its compiled targets, and the inputs of its final targets
+'''
+def save_shard(ninja_build_info: NinjaBooster, path:str) -> str:
+    compile_rules = ninja_build_info.filter_rules(contains="_COMPILER")
+    target_deps = {target: ninja_build_info.get_in_tree_target_dependencies(target)
+                   for rule in compile_rules for target in ninja_build_info.get_targets(rule)
+                   if ninja_build_info._in_shard(rule, target)}
+    reverse_index = defaultdict(list)
+    for target in sorted(target_deps):
+        for dep in target_deps[target]:
+            reverse_index[dep].append(target)
+    partial = {
+        "shard": ninja_build_info.shard,
+        "dependency_counts": count(target_deps)[0],
+        "target_folder_deps": ninja_build_info.get_dependencies_folder(target_deps),
+        "reverse_index": dict(reverse_index),
+        "final_target_inputs": ninja_build_info.target_inputs_per_file_target,
+    }
+    with open(path, "wb") as f:
+        pickle.dump(partial, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+'''
+    Merges the partial results of all shards (see save_shard) into the results of the whole build:
+    dependency counts, the reverse index, the folder dependencies of compiled targets and
+    of final targets (those of their inputs)
+'''
+def merge_shards(paths:list) -> dict:
+    merged = {"dependency_counts": Counter(), "target_folder_deps": dict(), "final_target_inputs": dict()}
+    split = None # (count, key) of the shards
+    indices = set()
+    reverse_index_parts = defaultdict(list)
+    for path in paths:
+        with open(path, "rb") as f:
+            partial = pickle.load(f)
+        index, shard_count, by = partial["shard"]
+        if split is None:
+            split = (shard_count, by)
+        elif (shard_count, by) != split:
+            raise ValueError(f"{path}: shard {partial['shard']} isn't from the same split as the others {split}")
+        if index in indices:
+            raise ValueError(f"{path}: shard {index} is given more than once")
+        indices.add(index)
+        merged["dependency_counts"].update(partial["dependency_counts"])
+        merged["target_folder_deps"].update(partial["target_folder_deps"])
+        merged["final_target_inputs"].update(partial["final_target_inputs"])
+        for dep, targets in partial["reverse_index"].items():
+            reverse_index_parts[dep].append(targets)
+    if split is None or len(indices) != split[0]:
+        missing = sorted(set(range(split[0])) - indices) if split else "all"
+        raise ValueError(f"Shards are missing: {missing}")
+    merged["reverse_index"] = {dep: list(heapq.merge(*parts)) for dep, parts in reverse_index_parts.items()}
+    target_folder_deps = merged["target_folder_deps"]
+    merged["final_target_folder_deps"] = {
+        final_target: set().union(*(target_folder_deps.get(i, ()) for i in inputs))
+        for final_target, inputs in merged["final_target_inputs"].items()}
+    return merged
+
+def _analyse_shard(args) -> str:
+    build_dir, root_folder, shard, path = args
+    return save_shard(NinjaBooster(build_dir, root_folder, build_all=False, shard=shard), path)
+
+'''
+    Analyses an already built tree in 'count' shards, in local processes, and merges their results
+'''
+def run_sharded(build_dir, count:int, by:str="hash", root_folder=None, jobs:int=None,
+                prefix:str="ninja_booster.shard") -> dict:
+    shards = [(build_dir, root_folder, (i, count, by), f"{prefix}.{i}") for i in range(count)]
+    with ProcessPoolExecutor(max_workers=jobs or min(count, os.cpu_count())) as pool:
+        paths = list(pool.map(_analyse_shard, shards))
+    return merge_shards(paths)
+
+'''
+    Saves the dependencies of the targets, to diff against another build (see diff_snapshots)
+    Paths in the source tree are relative to it, so that snapshots of different checkouts compare.
+    The path table is sorted and the dependencies of each target are a sorted array of path ids,
+    with a digest of their paths to find the changed targets without comparing the arrays.
+    The folder of a target is the one of its source (if any), dependencies between in-tree
+    folders are precomputed.
+'''
+def save_snapshot(ninja_build_info: NinjaBooster, path:str="ninja_booster.snapshot") -> str:
+    keys = dict() # path as ninja reports it -> path in the snapshot
+    def key(p):
+        k = keys.get(p)
+        if k is None:
+            abs_path = os.path.normpath(os.path.join(ninja_build_info.build_dir, p))
+            k = keys[p] = os.path.relpath(abs_path, ninja_build_info.root_folder) \
+                if ninja_build_info.in_tree(abs_path) else abs_path
+        return k
+
+    target_deps = ninja_build_info.file_dependencies_per_target
+    paths = sorted(set(key(p) for target, deps in target_deps.items() for p in [target] + deps))
+    ids = {p: i for i, p in enumerate(paths)}
+    durations = ninja_build_info.get_build_durations()
+    snapshot = {"version": SNAPSHOT_VERSION, "paths": paths, "deps": dict(), "digests": dict(),
+                "durations": dict(), "folders": dict()}
+    folder_deps = set()
+    for target, deps in target_deps.items():
+        t = ids[key(target)]
+        dep_keys = sorted(set(key(d) for d in deps))
+        snapshot["deps"][t] = array("I", (ids[k] for k in dep_keys))
+        snapshot["digests"][t] = hashlib.blake2b("\n".join(dep_keys).encode(), digest_size=16).digest()
+        if os.path.normpath(target) in durations:
+            snapshot["durations"][t] = durations[os.path.normpath(target)]
+        sources = [k for k in dep_keys if k.endswith(SOURCE_SUFFIXES)]
+        folder = snapshot["folders"][t] = os.path.dirname(sources[0] if sources else key(target))
+        if not os.path.isabs(folder):
+            folder_deps.update((folder, os.path.dirname(k)) for k in dep_keys if not os.path.isabs(k))
+    snapshot["folder_deps"] = sorted((a, b) for a, b in folder_deps if a != b)
+    with open(path, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+def load_snapshot(path:str) -> dict:
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"{path}: unsupported snapshot version {snapshot.get('version')}")
+    return snapshot
+
+def _merge_path_tables(paths, other_paths):
+    ''' Union of two sorted path tables, with the (increasing) id maps of both into it '''
+    union, ids, other_ids = [], array("I"), array("I")
+    i = j = 0
+    while i < len(paths) and j < len(other_paths):
+        if paths[i] < other_paths[j]:
+            ids.append(len(union))
+            union.append(paths[i])
+            i += 1
+        elif other_paths[j] < paths[i]:
+            other_ids.append(len(union))
+            union.append(other_paths[j])
+            j += 1
+        else:
+            ids.append(len(union))
+            other_ids.append(len(union))
+            union.append(paths[i])
+            i += 1
+            j += 1
+    ids.extend(range(len(union), len(union) + len(paths) - i))
+    union.extend(paths[i:])
+    other_ids.extend(range(len(union), len(union) + len(other_paths) - j))
+    union.extend(other_paths[j:])
+    return union, ids, other_ids
+
+def _diff_sorted_ids(ids, other_ids) -> tuple:
+    ''' Ids only in the first, and only in the second of two sorted id arrays '''
+    only, other_only = [], []
+    i = j = 0
+    while i < len(ids) and j < len(other_ids):
+        if ids[i] < other_ids[j]:
+            only.append(ids[i])
+            i += 1
+        elif other_ids[j] < ids[i]:
+            other_only.append(other_ids[j])
+            j += 1
+        else:
+            i += 1
+            j += 1
+    only.extend(ids[i:])
+    other_only.extend(other_ids[j:])
+    return only, other_only
+
+def _dependency_cycles(edges) -> list:
+    ''' Strongly connected components (with more than one node) of a graph given as edges, by Tarjan '''
+    graph = defaultdict(list)
+    for a, b in edges:
+        graph[a].append(b)
+    index, low, on_stack, stack, components = dict(), dict(), set(), [], []
+    for root in list(graph):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            v, successors = work[-1]
+            for w in successors:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(graph.get(w, ()))))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[v])
+                if low[v] == index[v]:
+                    component = set()
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.add(w)
+                        if w == v:
+                            break
+                    if len(component) > 1:
+                        components.append(frozenset(component))
+    return components
+
+'''
+    Differences between two snapshots (see save_snapshot), e.g. of a base and a PR build:
+    - targets added and removed, and the dependencies added and removed per target and per folder
+    - "fan-out": per dependency, the change of its number of users and of the build time
+      of its users (the cost of rebuilding after a change of it), highest first
+    - rebuild cost of both: the total of each target's build time times its number of
+      dependencies (unknown build times count as the mean of the known ones)
+    - folder dependency cycles in 'head' which are not in 'base'
+    Targets with the same digest in both are skipped, the dependencies of the others are compared
+    as sorted id arrays, mapped into the union of both path tables (the maps keep the order).
+'''
+def diff_snapshots(base:dict, head:dict) -> dict:
+    if base["paths"] == head["paths"]:
+        paths = head["paths"]
+        map_base = map_head = None
+    else:
+        paths, base_ids, head_ids = _merge_path_tables(base["paths"], head["paths"])
+        map_base, map_head = base_ids.__getitem__, head_ids.__getitem__
+    def targets_of(snapshot, id_map):
+        ''' Per target attributes by union id, dependencies are still in the snapshot ids '''
+        if id_map is None:
+            return tuple(snapshot[k] for k in ("deps", "digests", "durations", "folders"))
+        return tuple({id_map(t): v for t, v in snapshot[k].items()} for k in ("deps", "digests", "durations", "folders"))
+    base_deps, base_digests, base_durations, base_folders = targets_of(base, map_base)
+    head_deps, head_digests, head_durations, head_folders = targets_of(head, map_head)
+    def duration_getter(durations):
+        default = sum(durations.values()) / len(durations) if durations else 1.0
+        return lambda t: durations.get(t, default)
+    base_duration, head_duration = duration_getter(base_durations), duration_getter(head_durations)
+
+    empty = array("I")
+    deps_added, deps_removed = dict(), dict()
+    folders = defaultdict(lambda: [0, 0])
+    fanout = defaultdict(lambda: [0, 0.0])
+    for t in base_deps.keys() | head_deps.keys():
+        if base_digests.get(t, b"") == head_digests.get(t):
+            continue
+        before, after = base_deps.get(t, empty), head_deps.get(t, empty)
+        if map_base is not None:
+            before, after = array("I", map(map_base, before)), array("I", map(map_head, after))
+        added, removed = _diff_sorted_ids(after, before)
+        folder = head_folders.get(t, base_folders.get(t))
+        if added:
+            deps_added[paths[t]] = [paths[d] for d in added]
+            folders[folder][0] += len(added)
+            for d in added:
+                fanout[d][0] += 1
+                fanout[d][1] += head_duration(t)
+        if removed:
+            deps_removed[paths[t]] = [paths[d] for d in removed]
+            folders[folder][1] += len(removed)
+            for d in removed:
+                fanout[d][0] -= 1
+                fanout[d][1] -= base_duration(t)
+
+    base_cycles = _dependency_cycles(base["folder_deps"])
+    new_cycles = [sorted(c) for c in _dependency_cycles(head["folder_deps"])
+                  if not any(c <= b for b in base_cycles)]
+    return {
+        "targets_added": sorted(paths[t] for t in head_deps.keys() - base_deps.keys()),
+        "targets_removed": sorted(paths[t] for t in base_deps.keys() - head_deps.keys()),
+        "deps_added": deps_added,
+        "deps_removed": deps_removed,
+        "folders": {f: tuple(counts) for f, counts in folders.items()},
+        "fanout": sorted(((paths[d], users, cost) for d, (users, cost) in fanout.items() if users or cost),
+                         key=lambda f: f[2], reverse=True),
+        "rebuild_cost": tuple(sum(duration(t) * len(deps) for t, deps in deps_per_target.items())
+                              for duration, deps_per_target in ((base_duration, base_deps), (head_duration, head_deps))),
+        "new_cycles": new_cycles,
+    }
+
+def print_snapshot_diff(diff:dict, top:int=10):
+    base_cost, head_cost = diff["rebuild_cost"]
+    print(f"Targets: +{len(diff['targets_added'])} -{len(diff['targets_removed'])}, "
+          f"with dependencies added: {len(diff['deps_added'])}, removed: {len(diff['deps_removed'])}")
+    print(f"Rebuild cost: {base_cost:.1f} -> {head_cost:.1f} ({head_cost - base_cost:+.1f})")
+    for folder, (added, removed) in sorted(diff["folders"].items(), key=lambda f: f[1][0] - f[1][1], reverse=True)[:top]:
+        print(f"  {folder or '.'}: +{added} -{removed} dependencies")
+    for dep, users, cost in diff["fanout"][:top]:
+        if cost > 0:
+            print(f"  {dep}: {users:+d} users, rebuild cost {cost:+.1f}")
+    for cycle in diff["new_cycles"]:
+        print("New folder dependency cycle:", " ".join(cycle))
+
 def visualize(dict_to_visu, filename="graphviz", trim_str="", filtered_nodes:list = [], key_filename_only:bool = True, value_filename_only:bool = False):
     dot = graphviz.Digraph(comment='vizu',
         node_attr={
@@ -277,10 +1338,28 @@ def visualize(dict_to_visu, filename="graphviz", trim_str="", filtered_nodes:lis
     dot.render(filename=f'{filename}.dot', format='png', cleanup=False, outfile=f'{filename}.png')
 
 if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "diff":
+        # ninja_booster.py diff BASE_SNAPSHOT HEAD_SNAPSHOT
+        print_snapshot_diff(diff_snapshots(load_snapshot(sys.argv[2]), load_snapshot(sys.argv[3])))
+        sys.exit(0)
+
     # Arg parser:
     # TODO
     build_directory = "build/host_c66"
 
+    # Sharded analysis: "shard INDEX COUNT [KEY]" on each machine, then "merge PARTIALS..."
+    # or "sharded COUNT [KEY]" in local processes
+    if len(sys.argv) in (4, 5) and sys.argv[1] == "shard":
+        shard = (int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] if len(sys.argv) == 5 else "hash")
+        print(save_shard(NinjaBooster(build_directory, build_all=False, shard=shard), f"ninja_booster.shard.{shard[0]}"))
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] in ("merge", "sharded"):
+        merged = merge_shards(sys.argv[2:]) if sys.argv[1] == "merge" else \
+            run_sharded(build_directory, int(sys.argv[2]), *sys.argv[3:4])
+        print(f"{len(merged['target_folder_deps'])} compiled targets, {len(merged['reverse_index'])} dependencies")
+        print("TOP 5 dependencies are:", *merged["dependency_counts"].most_common(5), sep="\n")
+        sys.exit(0)
+
     # Create env.
     ninja_build_info = NinjaBooster(build_directory)
     target_dep_dict = get_compiled_target_deps(ninja_build_info, in_tree_only=True)
@@ -293,6 +1372,22 @@ if __name__ == "__main__":
     dependency_counts, dependency_set = count(target_dep_dict)
     print("TOP 5 dependencies are:", *dependency_counts.most_common(5), sep="\n")
 
+    # Precompiled headers
+    for unit, pch_headers, saved in recommend_pch(ninja_build_info)[:5]:
+        print(f"PCH candidate for {unit}: {len(pch_headers)} headers, ~{saved:.1f}s compile time saved")
+
+    # Unity builds
+    for unit, batch, saved, batch_time in recommend_unity_batches(ninja_build_info)[:5]:
+        print(f"Unity batch in {unit}: {len(batch)} targets ({batch_time:.1f}s), {saved} header parses saved")
+
+    # Include cuts
+    for header, included, saved, affected in recommend_include_cuts(ninja_build_info)[:5]:
+        print(f"Cut '{included}' from '{header}': {affected} targets, rebuild cost -{saved:.1f}")
+
+    # Ad-hoc queries, and a snapshot to diff with another build
+    export_sqlite(ninja_build_info)
+    save_snapshot(ninja_build_info)
+
     # Visualize
     visualize(target_dep_dict, filename="object_deps" ,trim_str=ninja_build_info.root_folder)# filtered_nodes=[""]
     visualize(target_folder_dependencies, filename="object_deps_folder_deps")# filtered_nodes=[""]